@@ -0,0 +1,114 @@
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+import queue
+import threading
+import time
+
+from modules.logger import logger
+
+
+class BatchScheduler:
+    """Gather single requests from many threads into batched calls.
+
+    ``submit`` queues one item and returns a Future. A scheduler thread takes the
+    first waiting item, keeps collecting for at most ``max_wait`` seconds or until
+    ``max_batch_size`` items are waiting, then runs ``batch_fn`` once on the whole
+    batch and completes every Future with its own result. While a batch runs the
+    next one fills up, so under load batches grow without waiting at all.
+    """
+
+    def __init__(self, name: str, batch_fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.005, log_interval: float = 300) -> None:
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.log_interval = log_interval
+        self._requests: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = { 'items': 0, 'batches': 0, 'queue_delay': 0.0, 'batch_time': 0.0 }
+        self._start_time = time.perf_counter()
+        self._last_log_time = self._start_time
+        self._thread = threading.Thread(target=self._run, name=f'BatchScheduler-{name}', daemon=True)
+        self._thread.start()
+        logger.info(f"Initialized BatchScheduler {self.name}, Max Batch Size: {self.max_batch_size}, Max Wait: {self.max_wait}")
+
+    def submit(self, item: Any) -> Future:
+        future: Future = Future()
+        self._requests.put((item, future, time.perf_counter()))
+        return future
+
+    def map(self, items: List[Any]) -> List[Any]:
+        """Submit every item and wait for all results, in order."""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect_batch(self) -> List[Tuple[Any, Future, float]]:
+        batch = [self._requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._requests.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            batch_start = time.perf_counter()
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"BatchScheduler {self.name} got {len(results)} results for {len(batch)} requests")
+            except Exception as exception:
+                for _, future, _ in batch:
+                    future.set_exception(exception)
+                continue
+            batch_end = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self._lock:
+                self._stats['items'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['queue_delay'] += sum(batch_start - submit_time for _, _, submit_time in batch)
+                self._stats['batch_time'] += batch_end - batch_start
+                log_stats = batch_end - self._last_log_time > self.log_interval
+                if log_stats:
+                    self._last_log_time = batch_end
+            if log_stats:
+                self.log_stats()
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            elapsed_time = max(time.perf_counter() - self._start_time, 1e-9)
+            items = self._stats['items']
+            batches = max(self._stats['batches'], 1)
+            return {
+                'items': items,
+                'batches': self._stats['batches'],
+                'average_queue_delay': self._stats['queue_delay'] / max(items, 1),
+                'average_batch_time': self._stats['batch_time'] / batches,
+                'fill_ratio': items / (batches * self.max_batch_size),
+                'throughput': items / elapsed_time
+            }
+
+    def log_stats(self) -> None:
+        stats = self.get_stats()
+        logger.info(
+            f"BatchScheduler {self.name}: "
+            f"Items: {stats['items']}, "
+            f"Batches: {stats['batches']}, "
+            f"Fill Ratio: {stats['fill_ratio']:.1%}, "
+            f"Average Queue Delay: {stats['average_queue_delay'] * 1000:.1f} ms, "
+            f"Average Batch: {stats['average_batch_time'] * 1000:.1f} ms, "
+            f"Throughput: {stats['throughput']:.1f}/s"
+        )
@@ -1,3 +1,6 @@
+import time
+# measured from the first import, the headless entry point should stay within IMPORT_TIME_BUDGET
+IMPORT_START_TIME = time.perf_counter()
 import os
 import sys
 # single thread doubles cuda performance - needs to be set before torch import
@@ -11,20 +14,18 @@ import platform
 import signal
 import shutil
 import argparse
-import torch
 import onnxruntime
-import tensorflow
 
 import modules.globals
 import modules.metadata
-import modules.qt_ui as ui
-from modules.processors.frame.core import get_frame_processors_modules
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from modules.logger import logger
+from modules.processors.frame.core import get_frame_processors_modules, process_video_chain
+from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, get_temp_output_path, normalize_output_path
 
-from modules.face_live import webcam
-
-if 'ROCMExecutionProvider' in modules.globals.execution_providers:
-    del torch
+# torch, tensorflow, the ui toolkit and the live pipeline are imported where they are used,
+# a restarted stream process should not pay for frameworks it never touches
+IMPORT_TIME_BUDGET = 1.0
+IMPORT_TIME_LOGGED = False
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -41,6 +42,33 @@ def parse_args() -> None:
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=True)
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
+    program.add_argument('--face-swapper-batch-size', help='number of faces swapped per inference run', dest='face_swapper_batch_size', type=int, default=8)
+    program.add_argument('--face-detect-interval', help='run the face detector every n frames of a stream and track the faces in between', dest='face_detect_interval', type=int, default=1)
+    program.add_argument('--face-detector-size', help='face detector input size as WIDTHxHEIGHT, or auto to derive it from the stream resolution', dest='face_detector_size', default='640x640')
+    program.add_argument('--face-enhancer-sessions', help='number of face enhancer sessions, 0 picks one from the execution provider', dest='face_enhancer_sessions', type=int, default=0)
+    program.add_argument('--face-enhancer-concurrency', help='concurrent runs per face enhancer session, 0 picks one from the execution provider', dest='face_enhancer_concurrency', type=int, default=0)
+    program.add_argument('--capture-backend', help='decoder used to read live input streams', dest='capture_backend', default='opencv', choices=['opencv', 'ffmpeg'])
+    program.add_argument('--capture-threads', help='ffmpeg capture decoder threads, 0 lets ffmpeg decide', dest='capture_threads', type=int, default=0)
+    program.add_argument('--capture-hwaccel', help='ffmpeg capture hardware decoder, e.g. cuda', dest='capture_hwaccel')
+    program.add_argument('--capture-scale', help='scale ffmpeg captured frames to WIDTHxHEIGHT', dest='capture_scale')
+    program.add_argument('--single-ingest', help='read the live input once with the ffmpeg decoder and mux its audio against the processed frames', dest='single_ingest', action='store_true', default=False)
+    program.add_argument('--load-shedding', help='reuse, pass through or drop live frames when the pipeline falls behind', dest='load_shedding', action='store_true', default=False)
+    program.add_argument('--latency-target', help='live latency in seconds above which frames are degraded by load shedding', dest='latency_target', type=float, default=0.5)
+    program.add_argument('--latency-max', help='live latency in seconds above which frames are dropped by load shedding', dest='latency_max', type=float, default=2.0)
+    program.add_argument('--frame-executor', help='run the live frame processors in threads or in worker processes', dest='frame_executor', default='thread', choices=['thread', 'process'])
+    program.add_argument('--frame-executor-workers', help='number of frame processor worker processes, 0 picks one from the cpu count', dest='frame_executor_workers', type=int, default=0)
+    program.add_argument('--inference-server', help='load the models once in an inference server process shared by every live stream', dest='inference_server', action='store_true', default=False)
+    program.add_argument('--standby-workers', help='stream processes kept loaded to take over a failed stream, each one costs a full set of models in gpu and host memory', dest='standby_workers', type=int, default=0)
+    program.add_argument('--batch-scheduler', help='gather the face swap requests of all in-flight frames into batched inference runs', dest='batch_scheduler', action='store_true', default=False)
+    program.add_argument('--batch-max-wait', help='seconds the batch scheduler waits to fill a batch', dest='batch_max_wait', type=float, default=0.005)
+    program.add_argument('--session-graph-optimization', help='onnx runtime graph optimization level', dest='session_graph_optimization', default='all', choices=['disabled', 'basic', 'extended', 'all'])
+    program.add_argument('--session-intra-op-threads', help='onnx runtime threads per session, 0 splits the cores between the sessions of every stream', dest='session_intra_op_threads', type=int, default=0)
+    program.add_argument('--session-inter-op-threads', help='onnx runtime threads running independent nodes of a session, 0 runs them sequentially', dest='session_inter_op_threads', type=int, default=0)
+    program.add_argument('--session-cudnn-conv-algo-search', help='cudnn convolution algorithm search of the cuda execution provider', dest='session_cudnn_conv_algo_search', default='DEFAULT', choices=['EXHAUSTIVE', 'HEURISTIC', 'DEFAULT'])
+    program.add_argument('--no-session-cache', help='do not cache the optimized models between starts', dest='session_cache', action='store_false', default=True)
+    program.add_argument('--video-pipeline', help='process videos through png frames on disk or stream them in memory from decoder to encoder', dest='video_pipeline', default='frames', choices=['frames', 'stream'])
+    program.add_argument('--video-segment-duration', help='minimum seconds of video per keyframe aligned segment of the stream video pipeline, 0 encodes in one piece', dest='video_segment_duration', type=float, default=60)
+    program.add_argument('--video-segment-workers', help='segments of the stream video pipeline decoded and encoded at once', dest='video_segment_workers', type=int, default=2)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
@@ -69,6 +97,33 @@ def parse_args() -> None:
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
     modules.globals.many_faces = args.many_faces
+    modules.globals.face_swapper_batch_size = args.face_swapper_batch_size
+    modules.globals.face_detect_interval = args.face_detect_interval
+    modules.globals.face_detector_size = args.face_detector_size
+    modules.globals.face_enhancer_sessions = args.face_enhancer_sessions
+    modules.globals.face_enhancer_concurrency = args.face_enhancer_concurrency
+    modules.globals.capture_backend = args.capture_backend
+    modules.globals.capture_threads = args.capture_threads
+    modules.globals.capture_hwaccel = args.capture_hwaccel
+    modules.globals.capture_scale = args.capture_scale
+    modules.globals.single_ingest = args.single_ingest
+    modules.globals.load_shedding = args.load_shedding
+    modules.globals.latency_target = args.latency_target
+    modules.globals.latency_max = args.latency_max
+    modules.globals.frame_executor = args.frame_executor
+    modules.globals.frame_executor_workers = args.frame_executor_workers
+    modules.globals.inference_server = args.inference_server
+    modules.globals.batch_scheduler = args.batch_scheduler
+    modules.globals.standby_workers = args.standby_workers
+    modules.globals.batch_max_wait = args.batch_max_wait
+    modules.globals.session_graph_optimization = args.session_graph_optimization
+    modules.globals.session_intra_op_threads = args.session_intra_op_threads
+    modules.globals.session_inter_op_threads = args.session_inter_op_threads
+    modules.globals.session_cudnn_conv_algo_search = args.session_cudnn_conv_algo_search
+    modules.globals.session_cache = args.session_cache
+    modules.globals.video_pipeline = args.video_pipeline
+    modules.globals.video_segment_duration = args.video_segment_duration
+    modules.globals.video_segment_workers = args.video_segment_workers
     modules.globals.video_encoder = args.video_encoder
     modules.globals.video_quality = args.video_quality
     modules.globals.max_memory = args.max_memory
@@ -136,10 +191,7 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_memory_growth(gpu, True)
+    # the tensorflow memory growth is set by modules.predicter when the nsfw model is loaded
     # limit memory usage
     if modules.globals.max_memory:
         memory = modules.globals.max_memory * 1024 ** 3
@@ -155,10 +207,26 @@ def limit_resources() -> None:
 
 
 def release_resources() -> None:
-    if 'CUDAExecutionProvider' in modules.globals.execution_providers:
+    # only a loaded torch holds a cuda cache, importing it here would just cost the import
+    torch = sys.modules.get('torch')
+    if torch and 'CUDAExecutionProvider' in modules.globals.execution_providers:
         torch.cuda.empty_cache()
 
 
+def log_import_time(scope: str) -> None:
+    # once per process, a standby that takes over a stream has long finished importing
+    global IMPORT_TIME_LOGGED
+
+    if IMPORT_TIME_LOGGED:
+        return
+    IMPORT_TIME_LOGGED = True
+    import_time = time.perf_counter() - IMPORT_START_TIME
+    if import_time > IMPORT_TIME_BUDGET:
+        logger.warning(f"Import time of the {scope} entry point: {import_time:.2f} s, over the budget of {IMPORT_TIME_BUDGET:.2f} s")
+    else:
+        logger.info(f"Import time of the {scope} entry point: {import_time:.2f} s")
+
+
 def pre_check() -> bool:
     if sys.version_info < (3, 9):
         update_status('Python version is not supported - please upgrade to 3.9 or higher.')
@@ -172,6 +240,7 @@ def pre_check() -> bool:
 def update_status(message: str, scope: str = 'DLC.CORE') -> None:
     print(f'[{scope}] {message}')
     if not modules.globals.headless:
+        import modules.qt_ui as ui
         ui.update_status(message)
 
 def start() -> None:
@@ -201,13 +270,16 @@ def start() -> None:
             destroy()
     update_status('Creating temp resources...')
     create_temp(modules.globals.target_path)
+    if modules.globals.video_pipeline == 'stream':
+        start_video_stream()
+        return
     update_status('Extracting frames...')
     extract_frames(modules.globals.target_path)
     temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
-        release_resources()
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    update_status('Progressing...', ', '.join(frame_processor.NAME for frame_processor in frame_processors))
+    process_video_chain(modules.globals.source_path, temp_frame_paths, frame_processors)
+    release_resources()
     # handles fps
     if modules.globals.keep_fps:
         update_status('Detecting fps...')
@@ -233,7 +305,23 @@ def start() -> None:
     else:
         update_status('Processing to video failed!')
 
+def start_video_stream() -> None:
+    # decode, process and encode in one pass, the frames never touch the disk
+    from modules.video_pipeline import process_video_stream
+
+    update_status('Processing video in memory...')
+    temp_output_path = get_temp_output_path(modules.globals.target_path)
+    if process_video_stream(modules.globals.source_path, modules.globals.target_path, temp_output_path):
+        move_temp(modules.globals.target_path, modules.globals.output_path)
+        clean_temp(modules.globals.target_path)
+        update_status('Processing to video succeed!')
+    else:
+        # the finished segments stay in the temp directory, the next run resumes after them
+        update_status('Processing to video failed!')
+
 def start_webcam():
+    from modules.face_live import webcam
+    log_import_time('headless')
     webcam()
     # ui.webcam_preview()
 
@@ -258,5 +346,7 @@ def run() -> None:
     # if modules.globals.webcam:
     #     start_webcam()
     else:
+        import modules.qt_ui as ui
+        log_import_time('ui')
         window = ui.init(start, destroy)
         window.mainloop()
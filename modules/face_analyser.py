@@ -1,12 +1,28 @@
-from typing import Any
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+import glob
+import math
+import os
+import threading
+import cv2
 import insightface
+import numpy
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo.landmark import Landmark
+from insightface.model_zoo.retinaface import RetinaFace
+from insightface.utils.storage import ensure_available
 
 import modules.globals
-from modules.typing import Frame
+from modules.inference_session import create_inference_session, get_execution_providers
+from modules.typing import Face, Frame
 from typing import List
 import onnxruntime
 
 FACE_ANALYSER = None
+FACE_ANALYSER_SCOPE = threading.local()
+FRAME_SIZE: Optional[Tuple[int, int]] = None
+THREAD_LOCK = threading.RLock()
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
     return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
@@ -17,18 +33,140 @@ def decode_execution_providers(execution_providers: List[str]) -> List[str]:
             if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
 
 
+class FaceAnalyser(insightface.app.FaceAnalysis):
+    """FaceAnalysis whose models run on sessions of the session factory.
+
+    The model zoo router creates its own sessions without our session options,
+    so the models are picked here by the same input and output shapes and built
+    on a factory session, each model file is loaded once.
+    """
+
+    def __init__(self, name: str, allowed_modules: Optional[List[str]], execution_providers: List[str], root: str = '~/.insightface') -> None:
+        onnxruntime.set_default_logger_severity(3)
+        self.models = {}
+        self.model_dir = ensure_available('models', name, root=root)
+        for model_file in sorted(glob.glob(os.path.join(self.model_dir, '*.onnx'))):
+            # without the optimized model cache, insightface reads the preprocessing from the original graph
+            model = create_face_analyser_model(model_file, create_inference_session(model_file, execution_providers, cache=False))
+            if model is None or model.taskname in self.models or (allowed_modules is not None and model.taskname not in allowed_modules):
+                continue
+            self.models[model.taskname] = model
+        assert 'detection' in self.models
+        self.det_model = self.models['detection']
+
+
+def create_face_analyser_model(model_file: str, session: Any) -> Any:
+    # same dispatch as insightface.model_zoo.model_zoo.ModelRouter
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_file, session=session)
+    if input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_file, session=session)
+    if input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_file, session=session)
+    if input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0 and len(inputs) == 1:
+        return ArcFaceONNX(model_file=model_file, session=session)
+    return None
+
+
 def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
-    if FACE_ANALYSER is None:
-        # FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=decode_execution_providers(["cuda"]))
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+    with THREAD_LOCK:
+        if FACE_ANALYSER is None:
+            FACE_ANALYSER = FaceAnalyser('buffalo_l', get_face_analyser_modules(), get_execution_providers())
+            FACE_ANALYSER.prepare(ctx_id=0, det_size=get_face_detector_size())
     return FACE_ANALYSER
 
 
+def get_face_analyser_modules() -> Optional[List[str]]:
+    from modules.processors.frame.core import load_frame_processor_module
+
+    if not modules.globals.frame_processors:
+        return None
+    face_analyser_modules = {'detection'}
+    for frame_processor in modules.globals.frame_processors:
+        frame_processor_module = load_frame_processor_module(frame_processor)
+        if not hasattr(frame_processor_module, 'FACE_ANALYSER_MODULES'):
+            return None
+        face_analyser_modules.update(frame_processor_module.FACE_ANALYSER_MODULES)
+    return sorted(face_analyser_modules)
+
+
+def get_face_detector_size() -> Tuple[int, int]:
+    if modules.globals.face_detector_size == 'auto':
+        if not FRAME_SIZE:
+            return 640, 640
+        # half of the longest side is plenty for the close-up faces of a stream
+        detector_side = math.ceil(max(FRAME_SIZE) / 2 / 32) * 32
+        detector_side = min(max(detector_side, 160), 640)
+        return detector_side, detector_side
+    detector_width, detector_height = modules.globals.face_detector_size.split('x')
+    return int(detector_width), int(detector_height)
+
+
+def set_frame_size(frame_width: int, frame_height: int) -> None:
+    global FRAME_SIZE
+
+    with THREAD_LOCK:
+        FRAME_SIZE = (frame_width, frame_height)
+        if FACE_ANALYSER is not None:
+            FACE_ANALYSER.prepare(ctx_id=0, det_size=get_face_detector_size())
+
+
+@contextmanager
+def face_analyser_scope() -> Iterator[None]:
+    """Share the analysed faces of a frame with every lookup made on that frame inside the scope."""
+    previous_scope = getattr(FACE_ANALYSER_SCOPE, 'faces', None)
+    FACE_ANALYSER_SCOPE.faces = {}
+    try:
+        yield
+    finally:
+        FACE_ANALYSER_SCOPE.faces = previous_scope
+
+
+def get_scope_faces(frame: Frame) -> Optional[List[Face]]:
+    scope_faces: Optional[Dict[int, Tuple[Frame, List[Face]]]] = getattr(FACE_ANALYSER_SCOPE, 'faces', None)
+    if scope_faces is None or id(frame) not in scope_faces:
+        return None
+    # the scope holds a reference to the frame, so its id cannot be reused while the scope is alive
+    scope_frame, faces = scope_faces[id(frame)]
+    if scope_frame is not frame:
+        return None
+    return faces
+
+
+def set_scope_faces(frame: Frame, faces: List[Face]) -> None:
+    scope_faces = getattr(FACE_ANALYSER_SCOPE, 'faces', None)
+    if scope_faces is not None:
+        scope_faces[id(frame)] = (frame, faces)
+
+
+def inherit_scope_faces(frame: Frame, processed_frame: Frame) -> None:
+    """Hand the faces of a frame to the frame a processor made of it.
+
+    The frame processors paste their results onto the faces they were given,
+    the face geometry of the output is the one of the input, so the next
+    processor in the chain does not have to detect the faces again.
+    """
+    if processed_frame is frame:
+        return
+    faces = get_scope_faces(frame)
+    if faces is not None:
+        set_scope_faces(processed_frame, faces)
+
+
+def analyse_faces(frame: Frame) -> List[Face]:
+    faces = get_scope_faces(frame)
+    if faces is None:
+        faces = get_face_analyser().get(frame)
+        set_scope_faces(frame, faces)
+    return faces
+
+
 def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+    face = analyse_faces(frame)
     try:
         return min(face, key=lambda x: x.bbox[0])
     except ValueError:
@@ -37,6 +175,6 @@ def get_one_face(frame: Frame) -> Any:
 
 def get_many_faces(frame: Frame) -> Any:
     try:
-        return get_face_analyser().get(frame)
+        return analyse_faces(frame)
     except IndexError:
         return None
@@ -1,25 +1,34 @@
 from modules.logger import logger
-from multiprocessing import Process, current_process
+from multiprocessing import Process, Queue, current_process
+from multiprocessing.connection import wait
 import cv2
 import subprocess
 import time
 import concurrent.futures
 import modules.globals
 import modules.metadata
-from modules.face_analyser import get_one_face
-from modules.processors.frame.core import get_frame_processors_modules
+from modules.core import log_import_time
+from modules.face_analyser import set_frame_size
+from modules.source_face_cache import get_source_face
+from modules.processors.frame.core import get_frame_processors_modules, supports_reuse
+import os
 import threading
 import queue
 import socket
 
+from modules.task_threads.audio_relay_thread import AudioRelayThread
+from modules.task_threads.ffmpeg_capture import FFmpegCapture
 from modules.task_threads.ffmpeg_streamer_process import FFmpegStreamerProcess
 from modules.task_threads.ffmpeg_subprocess import start_ffmpeg_process
 from modules.task_threads.frame_add_time_thread import FrameAddTimeThread
+from modules.task_threads.frame_buffer_pool import FrameBufferPool
 from modules.task_threads.frame_capture_thread import FrameCaptureThread
 from modules.task_threads.frame_processor_thread import FrameProcessorThread
 from modules.task_threads.frame_pull_thread import FramePullThread
+from modules.task_threads.frame_stage import FrameStage
 from modules.task_threads.frame_vis_thread import FrameVisThread
 from modules.task_threads.heart_beat_thread import HeartbeatThread
+from modules.task_threads.load_shedder import LoadShedder
 from modules.task_threads.rtmp_monitor_thread import RTMPMonitorThread
 from modules.task_threads.runtime_monitor_thread import RuntimeMonitorThread
 import signal
@@ -34,11 +43,23 @@ resource_lock = threading.Lock()
 #         raise RuntimeError(f"Cannot open input stream: {input_rtmp_url}")
 #     return cap
 
+def create_capture(input_rtmp_url):
+    """Create the capture backend selected by --capture-backend."""
+    if modules.globals.capture_backend == 'ffmpeg' or modules.globals.single_ingest:
+        return FFmpegCapture(
+            input_rtmp_url,
+            threads=modules.globals.capture_threads,
+            hwaccel=modules.globals.capture_hwaccel,
+            scale=modules.globals.capture_scale,
+            audio=modules.globals.single_ingest
+        )
+    return cv2.VideoCapture(input_rtmp_url)
+
 def open_input_stream(input_rtmp_url, delay=5):
     """Continuously attempt to open the input RTMP stream until successful."""
     while True:
         try:
-            cap = cv2.VideoCapture(input_rtmp_url)
+            cap = create_capture(input_rtmp_url)
             if cap.isOpened():
                 logger.info(f"Successfully opened input stream: {input_rtmp_url}")
                 return cap
@@ -50,7 +71,7 @@ def open_input_stream(input_rtmp_url, delay=5):
 
         time.sleep(delay)
 
-def cleanup_resources(cap, process):
+def cleanup_resources(cap, process, audio_relay=None):
     """Release resources, close video stream and FFmpeg process."""
     try:
         if cap.isOpened():
@@ -61,17 +82,75 @@ def cleanup_resources(cap, process):
 
     process.stop()
 
+    if audio_relay:
+        audio_relay.stop()
+
     logger.info("All resources released")
 
 
-def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
+def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors, on_first_frame=None):
     """Handle video streaming, capture, process frames, and push through FFmpeg."""
     logger.info(f"Face source: {face_source_path}")
+    frame_processor_names = frame_processors
     frame_processors = get_frame_processors_modules(frame_processors)
-    source_image = get_one_face(cv2.imread(face_source_path))
+    use_inference_server = modules.globals.inference_server_address is not None
+    # With the inference server the models, the source face and the tracker live in the server process
+    source_image = None if use_inference_server else get_source_face(face_source_path)
 
-    frame_queue = queue.Queue(maxsize=100)
     stop_event = threading.Event()
+    use_process_pool = modules.globals.frame_executor == 'process' and not use_inference_server
+    use_shared_frames = use_process_pool or use_inference_server
+    # Shared frames live in /dev/shm, a shorter queue keeps a 1080p stream at a few hundred MB
+    frame_queue_size = 16 if use_shared_frames else 100
+    max_in_flight = 24
+    frame_queue = FrameStage(stop_event, maxsize=frame_queue_size)
+    # Enough buffers for a full queue, the in-flight window and the frames being captured and written
+    frame_buffer_pool = FrameBufferPool(ffmpeg_processor.width, ffmpeg_processor.height, count=frame_queue_size + max_in_flight + 4, stop_event=stop_event, shared=use_shared_frames)
+    frame_process_pool = None
+    if use_inference_server:
+        from modules.inference_server import InferenceClient
+
+        try:
+            frame_process_pool = InferenceClient(
+                modules.globals.inference_server_address,
+                bytes.fromhex(modules.globals.inference_server_authkey),
+                frame_processor_names,
+                face_source_path,
+                frame_buffer_pool,
+                stop_event
+            )
+        except Exception:
+            frame_buffer_pool.close()
+            raise
+    elif use_process_pool:
+        from modules.task_threads.frame_process_pool import FrameProcessPool
+
+        try:
+            frame_process_pool = FrameProcessPool(
+                frame_processor_names,
+                face_source_path,
+                frame_buffer_pool,
+                stop_event,
+                workers=modules.globals.frame_executor_workers,
+                settings=snapshot_globals()
+            )
+        except Exception:
+            frame_buffer_pool.close()
+            raise
+    face_tracker = None
+    if modules.globals.face_detect_interval > 1 and not use_inference_server:
+        from modules.face_tracker import FaceTracker
+
+        face_tracker = FaceTracker(modules.globals.face_detect_interval)
+    load_shedder = None
+    if modules.globals.load_shedding:
+        load_shedder = LoadShedder(
+            target_latency=modules.globals.latency_target,
+            max_latency=modules.globals.latency_max,
+            queue_size=frame_queue.maxsize,
+            # reuse is only cheaper with tracked faces, and only smooth when every processor can reuse its result
+            allow_reuse=face_tracker is not None and all(supports_reuse(frame_processor) for frame_processor in frame_processors)
+        )
 
     
     # Start the frame capture thread
@@ -79,7 +158,9 @@ def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
         cap, 
         frame_queue, 
         stop_event, 
-        buffer_size=100
+        frame_buffer_pool,
+        buffer_size=frame_queue_size,
+        drop_when_full=load_shedder is not None
         )
     frame_capture_thread.start()
 
@@ -90,7 +171,12 @@ def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
         source_image=source_image,
         ffmpeg_processor=ffmpeg_processor,
         stop_event=stop_event,
-        max_workers=12
+        max_workers=12,
+        max_in_flight=max_in_flight,
+        batch_size=4,
+        face_tracker=face_tracker,
+        load_shedder=load_shedder,
+        process_pool=frame_process_pool
     )
     frame_processor_thread.start()
     
@@ -123,9 +209,12 @@ def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
     rtmp_monitor_thread.start()
 
     try:
-        while True:
-            # time.sleep(120)
-            
+        # Wake up once a second to supervise the threads, or immediately when the pipeline is stopped
+        while not stop_event.wait(timeout=1):
+            if on_first_frame and ffmpeg_processor.first_frame_time is not None:
+                on_first_frame(ffmpeg_processor.first_frame_time)
+                on_first_frame = None
+
             if not ffmpeg_processor.is_running():
                 logger.error("ffmpeg push processor have exited abnormally.")
                 break
@@ -158,6 +247,7 @@ def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
 
     finally:
         logger.info("Handler streaming : Stop  thread.")
+        frame_queue.close()
         frame_capture_thread.stop()
         frame_capture_thread.join(timeout=1)
 
@@ -182,6 +272,10 @@ def handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors):
 
         runtime_monitor_thread.stop()
         runtime_monitor_thread.join(timeout=1)
+
+        if frame_process_pool:
+            frame_process_pool.shutdown()
+        frame_buffer_pool.close()
         
         logger.info("done thread.")
 
@@ -195,7 +289,7 @@ def test(cap, process):
         # Check if the frame was read successfully
         if ret:
             # Display the resulting frame
-            process.stdin.write(frame.tobytes())
+            process.stdin.write(frame)
 
             # If successful, reset retries
             retries = 0
@@ -213,11 +307,70 @@ def signal_handler(sig, frame, ffmpeg_processor):
     logger.info("FFmpeg process stopped, exiting program.")
     exit(0)
     
-def stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_processors, restart_interval=1, max_retries=100):
-    """RTMP stream worker with retry mechanism."""
+def snapshot_globals():
+    """Collect the picklable settings of modules.globals for a spawned stream process."""
+    return {
+        name: value for name, value in vars(modules.globals).items()
+        if not name.startswith('__') and isinstance(value, (str, int, float, bool, list, dict, tuple, type(None)))
+    }
+
+def restore_globals(settings):
+    """Apply settings collected by snapshot_globals, spawned processes start from the module defaults."""
+    for name, value in (settings or {}).items():
+        setattr(modules.globals, name, value)
+
+def preload_stream_models(streams):
+    """Import the frame processors of the streams and load the models the stream process runs itself."""
+    # With the inference server or the process executor the models are loaded by other processes
+    load_models = modules.globals.inference_server_address is None and modules.globals.frame_executor != 'process'
+    for _, _, face_source_path, frame_processor_names in streams:
+        frame_processors = get_frame_processors_modules(frame_processor_names)
+        if not load_models:
+            continue
+        get_source_face(face_source_path)
+        for frame_processor in frame_processors:
+            if hasattr(frame_processor, 'warm_up'):
+                frame_processor.warm_up()
+
+def standby_worker(streams, assignment_queue, status_queue, settings=None):
+    """Standby stream process: load the models ahead of time, then take over the stream of a failed process."""
+    log_import_time('standby worker')
+    restore_globals(settings)
+    load_start_time = time.perf_counter()
+    preload_stream_models(streams)
+    status_queue.put(('ready', None, os.getpid(), time.perf_counter() - load_start_time))
+
+    assignment = assignment_queue.get()
+    if assignment is None:
+        return
+    stream_index, restart_time = assignment
+    input_rtmp_url, output_rtmp_url, face_source_path, frame_processors = streams[stream_index]
+    logger.info(f"Standby worker {os.getpid()} takes over stream {stream_index}: {input_rtmp_url}")
+    stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_processors, settings=settings, stream_index=stream_index, status_queue=status_queue, restart_time=restart_time)
+
+def stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_processors, restart_interval=1, max_retries=100, settings=None, stream_index=None, status_queue=None, restart_time=None):
+    """RTMP stream worker with retry mechanism.
+
+    ``restart_time`` is the wall clock time the previous attempt of the stream
+    failed, the delay until the first frame is written again is logged and
+    reported to the supervisor on ``status_queue``.
+    """
+    log_import_time('stream worker')
+    restore_globals(settings)
     retry_count = 0
+
+    def report_first_frame(first_frame_time):
+        nonlocal restart_time
+        if restart_time is None:
+            return
+        restart_delay = first_frame_time - restart_time
+        restart_time = None
+        logger.info(f"Stream {input_rtmp_url} restart to first frame: {restart_delay:.2f} seconds")
+        if status_queue is not None:
+            status_queue.put(('first_frame', stream_index, os.getpid(), restart_delay))
     
     ffmpeg_processor = None  # Initialize the ffmpeg_processor variable
+    audio_relay = None
 
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, lambda sig, frame: signal_handler(sig, frame, ffmpeg_processor))
@@ -232,13 +385,24 @@ def stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_proce
             width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             fps = cap.get(cv2.CAP_PROP_FPS) or 25  # Default to 25 fps if unknown
+            set_frame_size(width, height)
             # process = start_ffmpeg_process(width, height, fps, input_rtmp_url, output_rtmp_url)
-            ffmpeg_processor = FFmpegStreamerProcess(width, height, fps, input_rtmp_url, output_rtmp_url)
+            audio_relay = None
+            if modules.globals.single_ingest and cap.audio_fd is not None:
+                # The decoder tees the audio, the muxer takes it from the relay instead of the input url
+                audio_relay = AudioRelayThread(cap.audio_fd)
+                audio_relay.start()
+            ffmpeg_processor = FFmpegStreamerProcess(
+                width, height, fps, input_rtmp_url, output_rtmp_url,
+                audio_fd=audio_relay.output_fd if audio_relay else None,
+                audio_start_pts=audio_relay.wait_first_pts if audio_relay else None,
+                single_ingest=modules.globals.single_ingest
+            )
             ffmpeg_processor.start()
 
-            handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors)
+            handle_streaming(cap, ffmpeg_processor, face_source_path, frame_processors, on_first_frame=report_first_frame)
 
-            cleanup_resources(cap, ffmpeg_processor)
+            cleanup_resources(cap, ffmpeg_processor, audio_relay)
 
         except cv2.error as cv_err:
             logger.exception(f"OpenCV error: {cv_err}")
@@ -248,7 +412,9 @@ def stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_proce
             logger.exception(f"Unknown error during stream processing: {e}")
         finally:
             if 'cap' in locals():
-                cleanup_resources(cap, ffmpeg_processor)
+                cleanup_resources(cap, ffmpeg_processor, audio_relay)
+            if restart_time is None:
+                restart_time = time.time()
             logger.info(f"Waiting {restart_interval} seconds before retrying...")
             time.sleep(restart_interval)
             retry_count += 1
@@ -259,31 +425,121 @@ def stream_worker(input_rtmp_url, output_rtmp_url, face_source_path, frame_proce
 def manage_streams(streams):
     """Manage multiple RTMP streams, each in a separate process."""
     processes = []
+    inference_server_process = None
+    # the session factory splits the cores between the streams of this host
+    modules.globals.stream_count = len(streams)
+
+    def start_inference_server_process():
+        p = Process(
+            target=run_inference_server,
+            args=(snapshot_globals(), modules.globals.inference_server_address, bytes.fromhex(modules.globals.inference_server_authkey)),
+            name='InferenceServer'
+        )
+        p.daemon = True
+        p.start()
+        logger.info(f"Started inference server process {p.name}: {modules.globals.inference_server_address}")
+        return p
+
+    if modules.globals.inference_server:
+        from modules.inference_server import get_inference_server_address, run_inference_server
+
+        modules.globals.inference_server_address = get_inference_server_address()
+        modules.globals.inference_server_authkey = os.urandom(16).hex()
+        if os.path.exists(modules.globals.inference_server_address):
+            os.remove(modules.globals.inference_server_address)
+        inference_server_process = start_inference_server_process()
+
+    status_queue = Queue()
+    standby_workers = []
+    # restart to first frame delays per stream, logged as they are reported
+    restart_delays = { index: [] for index in range(len(streams)) }
+    # standbys to replace, per stream that took one over, with the latest time to start the replacement
+    standby_replacements = []
+
+    def start_standby_process():
+        assignment_queue = Queue()
+        p = Process(target=standby_worker, args=(streams, assignment_queue, status_queue), kwargs={'settings': snapshot_globals()})
+        p.daemon = modules.globals.frame_executor != 'process'
+        p.start()
+        logger.info(f"Started standby process {p.name}")
+        return p, assignment_queue
 
-    def start_stream_process(stream_info):
+    def start_stream_process(stream_index, restart_time=None):
         logger.info(f"=======================Start=======================")
-        input_url, output_url, face_source_path, frame_processors = stream_info
-        p = Process(target=stream_worker, args=(input_url, output_url, face_source_path, frame_processors))
-        p.daemon = True
+        input_url, output_url, face_source_path, frame_processors = streams[stream_index]
+        if standby_workers:
+            # The standby has the models loaded, it only has to open the streams
+            p, assignment_queue = standby_workers.pop(0)
+            assignment_queue.put((stream_index, restart_time))
+            # Loading a replacement now would compete with the takeover, it starts once the stream is live again
+            standby_replacements.append([stream_index, time.monotonic() + 60])
+            logger.info(f"Standby process {p.name} took over stream: {input_url} -> {output_url}")
+            return p
+        p = Process(
+            target=stream_worker,
+            args=(input_url, output_url, face_source_path, frame_processors),
+            kwargs={'settings': snapshot_globals(), 'stream_index': stream_index, 'status_queue': status_queue, 'restart_time': restart_time}
+        )
+        # Daemonic processes cannot start children, the process frame executor needs them
+        p.daemon = modules.globals.frame_executor != 'process'
         p.start()
-        logger.info(f"Started process {p.name} handling stream: {stream_info[0]} -> {stream_info[1]}")
+        logger.info(f"Started process {p.name} handling stream: {input_url} -> {output_url}")
 
         return p
 
-    for stream_info in streams:
-        p = start_stream_process(stream_info)
+    def read_status():
+        while True:
+            try:
+                status, stream_index, pid, duration = status_queue.get_nowait()
+            except queue.Empty:
+                return
+            if status == 'ready':
+                logger.info(f"Standby process {pid} is ready, models loaded in {duration:.2f} seconds")
+            elif status == 'first_frame' and stream_index in restart_delays:
+                for replacement in standby_replacements:
+                    if replacement[0] == stream_index:
+                        replacement[1] = 0
+                restart_delays[stream_index].append(duration)
+                delays = restart_delays[stream_index]
+                logger.info(
+                    f"Stream {stream_index} restart to first frame: {duration:.2f} seconds, "
+                    f"Average: {sum(delays) / len(delays):.2f} seconds, "
+                    f"Restarts: {len(delays)}"
+                )
+
+    for stream_index in range(len(streams)):
+        p = start_stream_process(stream_index)
         processes.append(p)
+    for _ in range(modules.globals.standby_workers):
+        standby_workers.append(start_standby_process())
 
-    
     try:
         while True:
+            read_status()
+            if inference_server_process and not inference_server_process.is_alive():
+                # The streams lose their connection and restart, they reconnect to the new server
+                logger.error("Inference server has stopped, restarting...")
+                if os.path.exists(modules.globals.inference_server_address):
+                    os.remove(modules.globals.inference_server_address)
+                inference_server_process = start_inference_server_process()
             for i, p in enumerate(processes):
                 if not p.is_alive():
                     logger.error(f"Process {p.name} has stopped, restarting...")
-                    processes[i] = start_stream_process(streams[i])
-            time.sleep(3)
+                    processes[i] = start_stream_process(i, restart_time=time.time())
+            for replacement in [replacement for replacement in standby_replacements if time.monotonic() >= replacement[1]]:
+                standby_replacements.remove(replacement)
+                standby_workers.append(start_standby_process())
+            for i, (p, _) in enumerate(standby_workers):
+                if not p.is_alive():
+                    logger.error(f"Standby process {p.name} has stopped, restarting...")
+                    standby_workers[i] = start_standby_process()
+            # Wake up as soon as any process exits, a failed stream is handed over without waiting
+            wait([p.sentinel for p in processes] + [p.sentinel for p, _ in standby_workers], timeout=1)
     except KeyboardInterrupt:
         logger.info("Termination signal received, shutting down...")
+        if inference_server_process:
+            processes.append(inference_server_process)
+        processes.extend(p for p, _ in standby_workers)
         for p in processes:
             p.terminate()
         for p in processes:
@@ -99,7 +99,7 @@ def push_frames(frame_queue, processed_frame, frame_processors, source_image):
         if frame is None:
             break
         processed_frame = process_single_frame(frame, frame_processors, source_image)
-        push_process.stdin.write(processed_frame.tobytes())
+        push_process.stdin.write(processed_frame)
     push_process.stdin.close()
     push_process.wait()
     
@@ -151,14 +151,14 @@ def webcam():
                     processed_frames = process_frames(frame_buffer, frame_processors, source_image)
                     
                     for processed_frame in processed_frames:
-                        push_process.stdin.write(processed_frame.tobytes())
+                        push_process.stdin.write(processed_frame)
 
                     frame_buffer = []
 
             if frame_buffer:
                 processed_frames = process_frames(frame_buffer, frame_processors, source_image)
                 for processed_frame in processed_frames:
-                    push_process.stdin.write(processed_frame.tobytes())
+                    push_process.stdin.write(processed_frame)
 
             cap.release()
             push_process.stdin.close()
@@ -0,0 +1,70 @@
+from typing import List, Optional
+import threading
+
+import cv2
+import numpy
+
+from modules.face_analyser import get_many_faces
+from modules.typing import Face, Frame
+
+
+class FaceTracker:
+    """Run the face detector every few frames and track the 5 keypoints in between.
+
+    The tracker holds per-stream state, so frames must be passed to ``track`` in
+    capture order. Keypoints are propagated with pyramidal Lucas-Kanade optical
+    flow and checked with a forward-backward pass; when a point is lost or drifts
+    more than ``max_error`` pixels the detector runs again on that frame.
+    """
+
+    def __init__(self, detect_interval: int = 5, max_error: float = 2.0) -> None:
+        self.detect_interval = max(1, detect_interval)
+        self.max_error = max_error
+        self.flow_parameters = dict(winSize=(21, 21), maxLevel=3, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+        self.detections = 0
+        self.tracks = 0
+        self._faces: List[Face] = []
+        self._previous_gray_frame: Optional[Frame] = None
+        self._frames_since_detection = 0
+        self._lock = threading.Lock()
+
+    def track(self, temp_frame: Frame) -> List[Face]:
+        with self._lock:
+            gray_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2GRAY)
+            faces = None
+            if self._faces and self._frames_since_detection + 1 < self.detect_interval:
+                faces = self.track_faces(gray_frame)
+            if faces is None:
+                faces = get_many_faces(temp_frame) or []
+                self._frames_since_detection = 0
+                self.detections += 1
+            else:
+                self._frames_since_detection += 1
+                self.tracks += 1
+            self._faces = faces
+            self._previous_gray_frame = gray_frame
+            return faces
+
+    def track_faces(self, gray_frame: Frame) -> Optional[List[Face]]:
+        previous_points = numpy.concatenate([face.kps for face in self._faces]).astype(numpy.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_gray_frame, gray_frame, previous_points, None, **self.flow_parameters)
+        if next_points is None or not status.all():
+            return None
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray_frame, self._previous_gray_frame, next_points, None, **self.flow_parameters)
+        if back_points is None or not back_status.all():
+            return None
+        if numpy.linalg.norm(back_points - previous_points, axis=2).max() > self.max_error:
+            return None
+        next_points = next_points.reshape(-1, 5, 2)
+        return [self.move_face(face, next_kps) for face, next_kps in zip(self._faces, next_points)]
+
+    def move_face(self, face: Face, next_kps: Frame) -> Face:
+        affine_matrix = cv2.estimateAffinePartial2D(face.kps.astype(numpy.float32), next_kps, method=cv2.LMEDS)[0]
+        if affine_matrix is None:
+            affine_matrix = numpy.float32([[1, 0, 0], [0, 1, 0]])
+        x1, y1, x2, y2 = face.bbox
+        corners = cv2.transform(numpy.float32([[[x1, y1], [x2, y1], [x1, y2], [x2, y2]]]), affine_matrix)[0]
+        next_face = Face(dict(face))
+        next_face.bbox = numpy.concatenate([corners.min(axis=0), corners.max(axis=0)]).astype(numpy.float32)
+        next_face.kps = next_kps.astype(numpy.float32)
+        return next_face
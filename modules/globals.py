@@ -18,7 +18,38 @@ keep_fps = None
 keep_audio = None
 keep_frames = None
 many_faces = None
+face_swapper_batch_size = 8
+face_detect_interval = 1
+face_detector_size = '640x640'
+face_enhancer_sessions = 0
+face_enhancer_concurrency = 0
+capture_backend = 'opencv'
+capture_threads = 0
+capture_hwaccel = None
+capture_scale = None
+single_ingest = False
+load_shedding = False
+latency_target = 0.5
+latency_max = 2.0
+frame_executor = 'thread'
+frame_executor_workers = 0
+inference_server = False
+batch_scheduler = False
+batch_max_wait = 0.005
+session_graph_optimization = 'all'
+session_intra_op_threads = 0
+session_inter_op_threads = 0
+session_cpu_mem_arena = True
+session_cudnn_conv_algo_search = 'DEFAULT'
+session_cache = True
+stream_count = 1
+standby_workers = 0
+inference_server_address = None
+inference_server_authkey = None
 video_encoder = None
+video_pipeline = 'frames'
+video_segment_duration = 60
+video_segment_workers = 2
 video_quality = None
 max_memory = None
 execution_providers: List[str] = []
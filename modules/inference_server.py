@@ -0,0 +1,335 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener, wait
+from typing import Any, Dict, List, Optional, Tuple
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+import numpy
+
+import modules.globals
+from modules.logger import logger
+
+
+def get_inference_server_address() -> str:
+    return os.path.join(tempfile.gettempdir(), f'facefusionlive-inference-{os.getpid()}.sock')
+
+
+def run_inference_server(settings: Dict[str, Any], address: str, authkey: bytes) -> None:
+    """Inference server process main."""
+    from modules.face_live import restore_globals
+
+    restore_globals(settings)
+    InferenceServer(address, authkey).serve_forever()
+
+
+class InferenceServerClient:
+    """Server side state of one connected stream process."""
+
+    def __init__(self, connection: Any) -> None:
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.shared_memory = None
+        self.frames: List[Any] = []
+        self.face_source_path = None
+        self.frame_processor_names: Tuple[str, ...] = ()
+        self.face_tracker = None
+        # one tracking thread per stream, tracking keeps its order without holding up the other streams
+        self.track_executor: Optional[ThreadPoolExecutor] = None
+
+    def register(self, shared_memory_name: str, frame_shape: Tuple[int, int, int], frame_count: int, face_source_path: str, frame_processor_names: List[str]) -> None:
+        from modules.face_tracker import FaceTracker
+
+        self.shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+        frame_size = int(numpy.prod(frame_shape))
+        self.frames = [numpy.ndarray(frame_shape, dtype=numpy.uint8, buffer=self.shared_memory.buf, offset=index * frame_size) for index in range(frame_count)]
+        self.face_source_path = face_source_path
+        self.frame_processor_names = tuple(frame_processor_names)
+        # frames of a stream arrive in capture order, so the stream's tracker lives here with the detector
+        if modules.globals.face_detect_interval > 1:
+            self.face_tracker = FaceTracker(modules.globals.face_detect_interval)
+            self.track_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='InferenceServerTrack')
+
+    def track(self, frames: List[Any]) -> Future:
+        """Track the faces of the frames after every window submitted before them."""
+        return self.track_executor.submit(self._track_frames, frames)
+
+    def _track_frames(self, frames: List[Any]) -> List[Any]:
+        return [self.face_tracker.track(frame) for frame in frames]
+
+    def send(self, message: Tuple[Any, ...]) -> None:
+        with self.send_lock:
+            try:
+                self.connection.send(message)
+            except (OSError, EOFError, BrokenPipeError):
+                pass
+
+    def close(self) -> None:
+        if self.track_executor is not None:
+            self.track_executor.shutdown(wait=False)
+        self.frames = []
+        if self.shared_memory is not None:
+            try:
+                self.shared_memory.close()
+            except BufferError:
+                logger.warning("InferenceServer stream frames are still referenced, leaving them mapped")
+            self.shared_memory = None
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+
+
+class InferenceServer:
+    """Own the models once and process the frames of every stream process.
+
+    Stream processes connect over a Unix socket, register the shared memory
+    block of their FrameBufferPool and then send only buffer indices. Requests
+    that arrive within ``max_wait`` seconds are grouped by source face and frame
+    processors, so streams swapping the same face share the batched inference
+    runs. Processed frames are written back into the stream's shared buffers.
+    """
+
+    def __init__(self, address: str, authkey: bytes, max_batch_frames: int = 16, max_wait: float = 0.005, workers: int = 4) -> None:
+        self.address = address
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        self.max_batch_frames = max_batch_frames
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.clients: Dict[Any, InferenceServerClient] = {}
+        self.source_faces: Dict[str, Any] = {}
+        self.frame_processors: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+        self._accept_thread = threading.Thread(target=self._accept_clients, name='InferenceServerAccept', daemon=True)
+
+        logger.info(
+            f"Initialized InferenceServer, "
+            f"Address: {self.address}, "
+            f"Max Batch Frames: {self.max_batch_frames}, "
+            f"Max Wait: {self.max_wait}, "
+            f"Workers: {workers}"
+        )
+
+    def _accept_clients(self) -> None:
+        while True:
+            try:
+                connection = self.listener.accept()
+            except Exception as e:
+                logger.error(f"InferenceServer failed to accept a stream: {e}")
+                continue
+            with self._lock:
+                self.clients[connection] = InferenceServerClient(connection)
+            logger.info(f"InferenceServer accepted a stream, Streams: {len(self.clients)}")
+
+    def serve_forever(self) -> None:
+        self._accept_thread.start()
+        try:
+            while True:
+                requests = self._collect_requests()
+                if requests:
+                    self._dispatch(requests)
+        finally:
+            self.listener.close()
+            self.executor.shutdown(wait=False)
+
+    def _collect_requests(self) -> List[Tuple[InferenceServerClient, int, List[int], Any]]:
+        """Wait for requests, then keep gathering for ``max_wait`` so streams can share a batch."""
+        requests: List[Tuple[InferenceServerClient, int, List[int], Any]] = []
+        deadline = None
+        while True:
+            with self._lock:
+                connections = list(self.clients)
+            timeout = 0.5 if deadline is None else max(0.0, deadline - time.monotonic())
+            if connections:
+                ready_connections = wait(connections, timeout=timeout)
+            else:
+                time.sleep(timeout)
+                ready_connections = []
+            for connection in ready_connections:
+                client = self.clients.get(connection)
+                if client:
+                    self._receive(client, requests)
+            frame_total = sum(len(frame_indices) for _, _, frame_indices, _ in requests)
+            if requests and deadline is None:
+                deadline = time.monotonic() + self.max_wait
+            if deadline is None:
+                continue
+            if frame_total >= self.max_batch_frames or time.monotonic() >= deadline:
+                return requests
+
+    def _receive(self, client: InferenceServerClient, requests: List[Tuple[InferenceServerClient, int, List[int], Any]]) -> None:
+        try:
+            while client.connection.poll():
+                message = client.connection.recv()
+                if message[0] == 'process':
+                    _, task_id, frame_indices, actions = message
+                    requests.append((client, task_id, frame_indices, actions))
+                elif message[0] == 'register':
+                    self._register(client, *message[1:])
+                elif message[0] == 'close':
+                    raise EOFError
+        except (EOFError, OSError):
+            self._remove(client)
+
+    def _register(self, client: InferenceServerClient, shared_memory_name: str, frame_shape: Tuple[int, int, int], frame_count: int, face_source_path: str, frame_processor_names: List[str]) -> None:
+        from modules.processors.frame.core import load_frame_processor_module
+        from modules.source_face_cache import get_source_face
+
+        try:
+            client.register(shared_memory_name, frame_shape, frame_count, face_source_path, frame_processor_names)
+            if client.frame_processor_names not in self.frame_processors:
+                # streams may run different processor chains, get_frame_processors_modules only keeps the first one
+                self.frame_processors[client.frame_processor_names] = [load_frame_processor_module(frame_processor) for frame_processor in client.frame_processor_names]
+            if face_source_path not in self.source_faces:
+                self.source_faces[face_source_path] = get_source_face(face_source_path)
+            client.send(('registered', None))
+        except Exception as e:
+            logger.error(f"InferenceServer failed to register a stream: {e}")
+            client.send(('registered', repr(e)))
+
+    def _remove(self, client: InferenceServerClient) -> None:
+        with self._lock:
+            self.clients.pop(client.connection, None)
+        client.close()
+        logger.info(f"InferenceServer closed a stream, Streams: {len(self.clients)}")
+
+    def _dispatch(self, requests: List[Tuple[InferenceServerClient, int, List[int], Any]]) -> None:
+        from modules.task_threads.load_shedder import PASSTHROUGH, PROCESS, REUSE
+
+        groups: Dict[Tuple[Any, Tuple[str, ...]], List[Tuple[InferenceServerClient, int, List[int], Any]]] = {}
+        for client, task_id, frame_indices, actions in requests:
+            if client.shared_memory is None:
+                continue
+            groups.setdefault((client.face_source_path, client.frame_processor_names), []).append((client, task_id, frame_indices, actions))
+
+        for (face_source_path, frame_processor_names), group in groups.items():
+            frames = []
+            track_futures: Optional[List[Future]] = []
+            group_actions = []
+            for client, _, frame_indices, actions in group:
+                client_frames = [client.frames[index] for index in frame_indices]
+                frames.extend(client_frames)
+                # the swapper keeps a single last result, reusing it could paste another stream's face
+                group_actions.extend(PASSTHROUGH if action == REUSE else action for action in (actions or [PROCESS] * len(frame_indices)))
+                # tracking detects every few frames, it runs on the stream's own thread instead of this collect thread
+                if client.face_tracker and track_futures is not None:
+                    track_futures.append(client.track(client_frames))
+                else:
+                    track_futures = None
+            self.executor.submit(self._process_group, self.frame_processors[frame_processor_names], self.source_faces[face_source_path], group, frames, track_futures, group_actions)
+
+    def _process_group(self, frame_processors: List[Any], source_face: Any, group: List[Tuple[InferenceServerClient, int, List[int], Any]], frames: List[Any], track_futures: Optional[List[Future]], actions: List[str]) -> None:
+        from modules.task_threads.frame_processor_thread import process_frame_window
+
+        start_time = time.perf_counter()
+        try:
+            frame_faces = [faces for track_future in track_futures for faces in track_future.result()] if track_futures is not None else None
+            processed_frames = process_frame_window(frame_processors, source_face, frames, frame_faces, actions)
+            for frame, processed_frame in zip(frames, processed_frames):
+                if processed_frame is not frame:
+                    numpy.copyto(frame, processed_frame)
+            error = None
+        except Exception as e:
+            logger.error(f"InferenceServer failed to process {len(frames)} frames: {e}")
+            error = repr(e)
+        processing_time = time.perf_counter() - start_time
+        for client, task_id, _, _ in group:
+            client.send(('done', task_id, error, processing_time))
+
+
+class InferenceClient:
+    """Stream side of the inference server, a drop-in for FrameProcessPool.
+
+    The frame buffer pool must be shared. ``submit`` sends the buffer indices of
+    a window and returns a Future of the processed frames. Face tracking runs on
+    the server next to the detector, so tracked faces are not sent.
+    """
+
+    def __init__(self, address: str, authkey: bytes, frame_processor_names: List[str], face_source_path: str, frame_buffer_pool: Any, stop_event: threading.Event, register_timeout: float = 300) -> None:
+        self.frame_buffer_pool = frame_buffer_pool
+        self._stop_event = stop_event
+        self._connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._futures: Dict[int, Tuple[Future, List[Any]]] = {}
+        self._task_ids = itertools.count()
+        self._closed = False
+
+        self._connection.send(('register', frame_buffer_pool.shared_memory_name, frame_buffer_pool.frame_shape, frame_buffer_pool.count, face_source_path, list(frame_processor_names)))
+        if not self._connection.poll(register_timeout):
+            self._connection.close()
+            raise RuntimeError(f"Inference server did not register the stream within {register_timeout} seconds")
+        _, error = self._connection.recv()
+        if error:
+            self._connection.close()
+            raise RuntimeError(f"Inference server rejected the stream: {error}")
+
+        self._receive_thread = threading.Thread(target=self._receive_results, name='InferenceClientResults', daemon=True)
+        self._receive_thread.start()
+
+        logger.info(
+            f"Initialized InferenceClient, "
+            f"Address: {address}, "
+            f"Frame Processors: {frame_processor_names}"
+        )
+
+    def submit(self, frame_buffers: List[Any], frame_faces: Any = None, actions: Any = None, sequences: Any = None) -> Future:
+        future: Future = Future()
+        if self._closed:
+            future.set_exception(RuntimeError("InferenceClient is closed"))
+            return future
+        if not all(frame_buffer.shared for frame_buffer in frame_buffers):
+            future.set_exception(RuntimeError("Frame is not in the shared frame buffer pool, the stream changed its frame size"))
+            return future
+
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._futures[task_id] = (future, frame_buffers)
+        try:
+            with self._send_lock:
+                self._connection.send(('process', task_id, [frame_buffer.index for frame_buffer in frame_buffers], actions))
+        except (OSError, EOFError) as e:
+            self._fail_pending(f"Inference server connection lost: {e}")
+        return future
+
+    def _receive_results(self) -> None:
+        while not self._closed:
+            try:
+                _, task_id, error, processing_time = self._connection.recv()
+            except (EOFError, OSError) as e:
+                if not self._closed:
+                    self._fail_pending(f"Inference server connection lost: {e}")
+                break
+            with self._lock:
+                future, frame_buffers = self._futures.pop(task_id, (None, None))
+            if future is None:
+                continue
+            if error:
+                future.set_exception(RuntimeError(f"Inference server failed: {error}"))
+            else:
+                future.processing_time = processing_time
+                future.set_result([frame_buffer.frame for frame_buffer in frame_buffers])
+
+    def _fail_pending(self, reason: str) -> None:
+        logger.error(f"InferenceClient: {reason}, stopping the stream")
+        self._closed = True
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future, _ in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(reason))
+        self._stop_event.set()
+
+    def shutdown(self) -> None:
+        self._closed = True
+        try:
+            with self._send_lock:
+                self._connection.send(('close',))
+        except (OSError, EOFError):
+            pass
+        self._connection.close()
+        logger.info("InferenceClient shut down")
@@ -0,0 +1,228 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import hashlib
+import os
+import queue
+import threading
+import time
+
+import onnxruntime
+
+import modules.globals
+from modules.logger import logger
+from modules.utilities import resolve_relative_path
+
+GPU_EXECUTION_PROVIDERS = ['CUDAExecutionProvider', 'TensorrtExecutionProvider', 'ROCMExecutionProvider', 'DmlExecutionProvider', 'CoreMLExecutionProvider']
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disabled': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+SESSION_CACHE_DIRECTORY = resolve_relative_path('../.caches/sessions')
+
+
+def get_execution_providers() -> List[str]:
+    if modules.globals.execution_providers:
+        return modules.globals.execution_providers
+    available_providers = onnxruntime.get_available_providers()
+    if 'CUDAExecutionProvider' in available_providers:
+        return ['CUDAExecutionProvider']
+    return ['CPUExecutionProvider']
+
+
+def uses_gpu(execution_providers: List[str]) -> bool:
+    return any(execution_provider in GPU_EXECUTION_PROVIDERS for execution_provider in execution_providers)
+
+
+def get_session_process_count() -> int:
+    """Number of processes on this host that hold their own inference sessions."""
+    if modules.globals.inference_server_address:
+        return 1
+    process_count = max(1, modules.globals.stream_count)
+    if modules.globals.frame_executor == 'process':
+        from modules.task_threads.frame_process_pool import suggest_frame_process_workers
+
+        process_count *= modules.globals.frame_executor_workers or suggest_frame_process_workers()
+    return process_count
+
+
+def get_intra_op_threads(execution_providers: List[str], session_count: int = 1) -> int:
+    if modules.globals.session_intra_op_threads:
+        return modules.globals.session_intra_op_threads
+    if uses_gpu(execution_providers):
+        # only the operators that fall back to the cpu use these threads
+        return 2
+    # split the cores between every session of every process instead of letting each claim all of them
+    return max(1, (os.cpu_count() or 1) // (get_session_process_count() * max(1, session_count)))
+
+
+def get_session_options(execution_providers: Optional[List[str]] = None, session_count: int = 1) -> onnxruntime.SessionOptions:
+    execution_providers = execution_providers or get_execution_providers()
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[modules.globals.session_graph_optimization]
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    session_options.intra_op_num_threads = get_intra_op_threads(execution_providers, session_count)
+    session_options.inter_op_num_threads = modules.globals.session_inter_op_threads or 1
+    session_options.enable_cpu_mem_arena = modules.globals.session_cpu_mem_arena
+    return session_options
+
+
+def get_provider_options(execution_providers: List[str]) -> List[Dict[str, Any]]:
+    provider_options = []
+    for execution_provider in execution_providers:
+        if execution_provider == 'CUDAExecutionProvider':
+            provider_options.append({
+                'cudnn_conv_algo_search': modules.globals.session_cudnn_conv_algo_search,
+                # grow the arena by what is requested, doubling it wastes memory with several sessions per device
+                'arena_extend_strategy': 'kSameAsRequested'
+            })
+        elif execution_provider == 'TensorrtExecutionProvider':
+            provider_options.append({
+                'trt_engine_cache_enable': True,
+                'trt_engine_cache_path': SESSION_CACHE_DIRECTORY,
+                'trt_fp16_enable': True
+            })
+        else:
+            provider_options.append({})
+    return provider_options
+
+
+def get_optimized_model_path(model_path: str, execution_providers: List[str]) -> str:
+    model_stat = os.stat(model_path)
+    cache_key = '|'.join([
+        os.path.abspath(model_path),
+        str(model_stat.st_mtime),
+        str(model_stat.st_size),
+        onnxruntime.__version__,
+        ','.join(execution_providers),
+        modules.globals.session_graph_optimization
+    ])
+    model_name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(SESSION_CACHE_DIRECTORY, model_name + '.' + hashlib.sha1(cache_key.encode()).hexdigest()[:16] + '.onnx')
+
+
+def create_inference_session(model_path: str, execution_providers: Optional[List[str]] = None, session_count: int = 1, cache: bool = True) -> onnxruntime.InferenceSession:
+    """Create a session with the configured options, reusing the optimized model of an earlier start."""
+    execution_providers = execution_providers or get_execution_providers()
+    session_options = get_session_options(execution_providers, session_count)
+    provider_options = get_provider_options(execution_providers)
+    # compiled tensorrt nodes cannot be serialized, tensorrt keeps its own engine cache
+    cache = cache and modules.globals.session_cache and 'TensorrtExecutionProvider' not in execution_providers
+    if not cache:
+        return onnxruntime.InferenceSession(model_path, sess_options = session_options, providers = execution_providers, provider_options = provider_options)
+
+    optimized_model_path = get_optimized_model_path(model_path, execution_providers)
+    if os.path.isfile(optimized_model_path):
+        optimized_session_options = get_session_options(execution_providers, session_count)
+        optimized_session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return onnxruntime.InferenceSession(optimized_model_path, sess_options = optimized_session_options, providers = execution_providers, provider_options = provider_options)
+        except Exception as exception:
+            logger.warning(f"Ignoring unusable optimized model {optimized_model_path}: {exception}")
+            os.remove(optimized_model_path)
+
+    os.makedirs(SESSION_CACHE_DIRECTORY, exist_ok=True)
+    # write to a temporary file first so concurrent starts never load a partial model
+    temp_model_path = optimized_model_path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    session_options.optimized_model_filepath = temp_model_path
+    try:
+        session = onnxruntime.InferenceSession(model_path, sess_options = session_options, providers = execution_providers, provider_options = provider_options)
+    except Exception as exception:
+        logger.warning(f"Could not save the optimized model of {model_path}, creating the session without it: {exception}")
+        return create_inference_session(model_path, execution_providers, session_count, cache = False)
+    if os.path.isfile(temp_model_path):
+        os.replace(temp_model_path, optimized_model_path)
+    return session
+
+
+def suggest_session_pool_size(execution_providers: List[str]) -> Tuple[int, int]:
+    """Return (sessions, concurrent runs per session) for the given execution providers."""
+    if any(execution_provider in GPU_EXECUTION_PROVIDERS for execution_provider in execution_providers):
+        # one copy of the weights on the device, overlapping runs keep it busy
+        return 1, 2
+    # one single-run session per group of four cores keeps the intra op threads from oversubscribing
+    return max(1, min(4, (os.cpu_count() or 1) // 4)), 1
+
+
+class InferenceSessionPool:
+    """Share a fixed number of inference runs between worker threads.
+
+    The pool holds ``session_count`` sessions and admits ``runs_per_session`` concurrent
+    runs on each of them. Callers block in ``acquire`` while every slot is busy, which
+    pushes back on the worker threads instead of piling them up on a single lock.
+    """
+
+    def __init__(self, name: str, create_session: Callable[[int], Any], session_count: int = 1, runs_per_session: int = 1, log_interval: float = 300) -> None:
+        self.name = name
+        self.session_count = max(1, session_count)
+        self.runs_per_session = max(1, runs_per_session)
+        self.sessions = [create_session(session_index) for session_index in range(self.session_count)]
+        self.log_interval = log_interval
+        self._slots: queue.Queue = queue.Queue()
+        for _ in range(self.runs_per_session):
+            for session_index in range(self.session_count):
+                self._slots.put(session_index)
+        self._lock = threading.Lock()
+        self._stats = [{ 'runs': 0, 'busy_time': 0.0, 'wait_time': 0.0 } for _ in range(self.session_count)]
+        self._waiting = 0
+        self._max_waiting = 0
+        self._start_time = time.perf_counter()
+        self._last_log_time = self._start_time
+        logger.info(f"Initialized InferenceSessionPool {self.name}, Sessions: {self.session_count}, Runs Per Session: {self.runs_per_session}")
+
+    @contextmanager
+    def acquire(self, timeout: float = None) -> Iterator[Tuple[int, Any]]:
+        """Borrow a session slot, yields (session index, session)."""
+        wait_start = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+            self._max_waiting = max(self._max_waiting, self._waiting)
+        try:
+            session_index = self._slots.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No {self.name} session became available within {timeout} seconds")
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        run_start = time.perf_counter()
+        try:
+            yield session_index, self.sessions[session_index]
+        finally:
+            run_end = time.perf_counter()
+            self._slots.put(session_index)
+            with self._lock:
+                session_stats = self._stats[session_index]
+                session_stats['runs'] += 1
+                session_stats['busy_time'] += run_end - run_start
+                session_stats['wait_time'] += run_start - wait_start
+                log_stats = run_end - self._last_log_time > self.log_interval
+                if log_stats:
+                    self._last_log_time = run_end
+            if log_stats:
+                self.log_stats()
+
+    def get_stats(self) -> List[Dict[str, float]]:
+        with self._lock:
+            elapsed_time = max(time.perf_counter() - self._start_time, 1e-9)
+            return [
+                {
+                    'runs': session_stats['runs'],
+                    'utilisation': session_stats['busy_time'] / (elapsed_time * self.runs_per_session),
+                    'average_run_time': session_stats['busy_time'] / max(session_stats['runs'], 1),
+                    'average_wait_time': session_stats['wait_time'] / max(session_stats['runs'], 1),
+                    'max_waiting': self._max_waiting
+                }
+                for session_stats in self._stats
+            ]
+
+    def log_stats(self) -> None:
+        for session_index, session_stats in enumerate(self.get_stats()):
+            logger.info(
+                f"InferenceSessionPool {self.name} session {session_index}: "
+                f"Runs: {session_stats['runs']}, "
+                f"Utilisation: {session_stats['utilisation']:.1%}, "
+                f"Average Run: {session_stats['average_run_time'] * 1000:.1f} ms, "
+                f"Average Wait: {session_stats['average_wait_time'] * 1000:.1f} ms, "
+                f"Max Waiting: {session_stats['max_waiting']}"
+            )
@@ -1,13 +1,31 @@
+import threading
 import numpy
-import opennsfw2
 from PIL import Image
 
 from modules.typing import Frame
 
+OPENNSFW2 = None
+THREAD_LOCK = threading.Lock()
 MAX_PROBABILITY = 0.85
 
 
+def get_opennsfw2():
+    # opennsfw2 pulls in tensorflow, load it only when a prediction is asked for
+    global OPENNSFW2
+
+    with THREAD_LOCK:
+        if OPENNSFW2 is None:
+            import tensorflow
+            # prevent tensorflow memory leak
+            for gpu in tensorflow.config.experimental.list_physical_devices('GPU'):
+                tensorflow.config.experimental.set_memory_growth(gpu, True)
+            import opennsfw2
+            OPENNSFW2 = opennsfw2
+    return OPENNSFW2
+
+
 def predict_frame(target_frame: Frame) -> bool:
+    opennsfw2 = get_opennsfw2()
     image = Image.fromarray(target_frame)
     image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
     model = opennsfw2.make_open_nsfw_model()
@@ -17,9 +35,11 @@ def predict_frame(target_frame: Frame) -> bool:
 
 
 def predict_image(target_path: str) -> bool:
+    opennsfw2 = get_opennsfw2()
     return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
 
 
 def predict_video(target_path: str) -> bool:
+    opennsfw2 = get_opennsfw2()
     _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
     return any(probability > MAX_PROBABILITY for probability in probabilities)
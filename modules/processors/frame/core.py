@@ -1,12 +1,17 @@
 import sys
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import functools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional, Tuple
 from tqdm import tqdm
 
+import cv2
+
 import modules
 import modules.globals                   
+from modules.logger import logger
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -55,14 +60,88 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
             except:
                 pass
 
+def supports_reuse(frame_processor: ModuleType) -> bool:
+    # processors declare SUPPORTS_REUSE when they keep their last result and can paste it onto a later frame
+    return getattr(frame_processor, 'SUPPORTS_REUSE', False)
+
+
+def clear_reuse_state(frame_processors: List[ModuleType]) -> None:
+    # the kept results belong to one run of the stream, its sequence numbers start again on the next one
+    for frame_processor in frame_processors:
+        if supports_reuse(frame_processor):
+            frame_processor.clear_reuse_state()
+
+
+def process_frame_batch(frame_processor: ModuleType, source_face: Any, temp_frames: List[Any], sequences: Optional[List[int]] = None) -> List[Any]:
+    # processors with a reuse path keep their last result, the stream sequence numbers keep it in capture order
+    if supports_reuse(frame_processor):
+        return frame_processor.process_frame_batch(source_face, temp_frames, sequences)
+    if hasattr(frame_processor, 'process_frame_batch'):
+        return frame_processor.process_frame_batch(source_face, temp_frames)
+    return [frame_processor.process_frame(source_face, temp_frame) for temp_frame in temp_frames]
+
+
+def reuse_frame(frame_processor: ModuleType, source_face: Any, temp_frame: Any, sequence: Optional[int] = None) -> Any:
+    # processors without a cheap way to reuse their last result leave the frame as it is
+    if supports_reuse(frame_processor):
+        return frame_processor.reuse_frame(source_face, temp_frame, sequence)
+    return temp_frame
+
+
+def get_work_unit_size(frame_time: float, remaining_frames: int, workers: int, target_unit_time: float = 0.5, max_unit_size: int = 64) -> int:
+    """Frames per work unit from the measured time per frame.
+
+    A unit should take about ``target_unit_time`` so the submission overhead is
+    amortized, but stay small enough near the end of the video that every
+    worker still gets a share of the remaining frames.
+    """
+    if frame_time <= 0:
+        return 1
+    unit_size = int(target_unit_time / frame_time)
+    balanced_unit_size = remaining_frames // (workers * 4)
+    return max(1, min(unit_size, max_unit_size, balanced_unit_size))
+
+
+def run_work_unit(process_frames: Callable[[str, List[str], Any], None], source_path: str, temp_frame_paths: List[str], progress: Any = None) -> Tuple[float, int]:
+    start_time = time.perf_counter()
+    process_frames(source_path, temp_frame_paths, progress)
+    return time.perf_counter() - start_time, len(temp_frame_paths)
+
+
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
-            futures.append(future)
-        for future in futures:
-            future.result()
+    """Process the frame paths in work units on the execution threads, with at most two units per thread in flight.
+
+    The first units hold a single frame, later ones are sized from the moving
+    average time per frame, so memory stays flat whatever the video length.
+    """
+    workers = modules.globals.execution_threads or 1
+    max_in_flight = workers * 2
+    frame_time = 0.0
+    position = 0
+    unit_count = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while position < len(temp_frame_paths) or pending:
+            while position < len(temp_frame_paths) and len(pending) < max_in_flight:
+                unit_size = get_work_unit_size(frame_time, len(temp_frame_paths) - position, workers)
+                pending.add(executor.submit(run_work_unit, process_frames, source_path, temp_frame_paths[position:position + unit_size], progress))
+                position += unit_size
+                unit_count += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit_time, unit_frames = future.result()
+                unit_frame_time = unit_time / unit_frames
+                frame_time = unit_frame_time if not frame_time else frame_time + 0.2 * (unit_frame_time - frame_time)
+
+    elapsed_time = max(time.perf_counter() - start_time, 1e-9)
+    logger.info(
+        f"Processed {len(temp_frame_paths)} frames, "
+        f"Work Units: {unit_count}, "
+        f"Average Unit Size: {len(temp_frame_paths) / max(unit_count, 1):.1f}, "
+        f"Elapsed: {elapsed_time:.1f} s, "
+        f"Throughput: {len(temp_frame_paths) / elapsed_time:.1f} frames/s"
+    )
 
 
 def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
@@ -71,3 +150,39 @@ def process_video(source_path: str, frame_paths: list[str], process_frames: Call
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
         progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
         multi_process_frame(source_path, frame_paths, process_frames, progress)
+
+
+def needs_source_face(frame_processors: List[ModuleType]) -> bool:
+    # processors declare NEEDS_SOURCE_FACE when they take the source face, the others ignore it
+    return any(getattr(frame_processor, 'NEEDS_SOURCE_FACE', False) for frame_processor in frame_processors)
+
+
+def get_chain_source_face(frame_processors: List[ModuleType], source_path: Optional[str]) -> Any:
+    from modules.source_face_cache import get_source_face
+
+    # an enhancer only chain runs without a source image
+    if not source_path or not needs_source_face(frame_processors):
+        return None
+    return get_source_face(source_path)
+
+
+def process_frames_chain(frame_processors: List[ModuleType], source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
+    from modules.task_threads.frame_processor_thread import process_frame_window
+
+    source_face = get_chain_source_face(frame_processors, source_path)
+    for temp_frame_path in temp_frame_paths:
+        temp_frame = cv2.imread(temp_frame_path)
+        try:
+            # one read and one write per frame, the faces detected for the first processor are reused by the others
+            result = process_frame_window(frame_processors, source_face, [temp_frame])[0]
+            cv2.imwrite(temp_frame_path, result)
+        except Exception as exception:
+            print(exception)
+            pass
+        if progress:
+            progress.update(1)
+
+
+def process_video_chain(source_path: str, frame_paths: List[str], frame_processors: List[ModuleType]) -> None:
+    """Run the whole processor chain over every frame in a single pass instead of one pass per processor."""
+    process_video(source_path, frame_paths, functools.partial(process_frames_chain, frame_processors))
@@ -9,23 +9,16 @@ import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
 from modules.face_analyser import get_one_face
+from modules.inference_session import InferenceSessionPool, create_inference_session, get_execution_providers, suggest_session_pool_size
 from modules.typing import Frame, Face, Matrix
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
 from typing import Any, List, Tuple, Dict
 
 FACE_ENHANCER = None
-THREAD_SEMAPHORE = threading.Semaphore()
+FACE_ENHANCER_ENGINE = None
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-ENHANCER'
-
-def encode_execution_providers(execution_providers: List[str]) -> List[str]:
-    return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
-
-
-def decode_execution_providers(execution_providers: List[str]) -> List[str]:
-    return [provider for provider, encoded_execution_provider in zip(onnxruntime.get_available_providers(), encode_execution_providers(onnxruntime.get_available_providers()))
-            if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
-
+FACE_ANALYSER_MODULES = ['detection']
 
 def pre_check() -> bool:
     download_directory_path = resolve_relative_path('../models')
@@ -38,82 +31,184 @@ def pre_start() -> bool:
         return False
     return True
 
-def get_face_enhancer() -> Any:
+def get_face_enhancer() -> InferenceSessionPool:
     global FACE_ENHANCER
 
     with THREAD_LOCK:
         if FACE_ENHANCER is None:
             # model_path = resolve_relative_path('../models/codeformer.onnx')
             model_path = resolve_relative_path('../models/gpen_bfr_512.onnx')
-            FACE_ENHANCER = onnxruntime.InferenceSession(model_path, providers =decode_execution_providers(['cuda']))
-    return FACE_ENHANCER
+            execution_providers = get_execution_providers()
+            session_count, runs_per_session = suggest_session_pool_size(execution_providers)
+            session_count = modules.globals.face_enhancer_sessions or session_count
+            runs_per_session = modules.globals.face_enhancer_concurrency or runs_per_session
 
+            def create_session(session_index: int) -> Any:
+                return create_inference_session(model_path, execution_providers, session_count)
 
-def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
-	frame_processor = get_face_enhancer()
-	crop_frame, affine_matrix = warp_face(target_face, temp_frame)
-	crop_frame = prepare_crop_frame(crop_frame)
-	frame_processor_inputs = {}
-	for frame_processor_input in frame_processor.get_inputs():
-		if frame_processor_input.name == 'input':
-			frame_processor_inputs[frame_processor_input.name] = crop_frame
-		if frame_processor_input.name == 'weight':
-			frame_processor_inputs[frame_processor_input.name] = numpy.array([ 1 ], dtype = numpy.double)
-	with THREAD_SEMAPHORE:
-		crop_frame = frame_processor.run(None, frame_processor_inputs)[0][0]
-	crop_frame = normalize_crop_frame(crop_frame)
-	paste_frame = paste_back(temp_frame, crop_frame, affine_matrix)
-	temp_frame = blend_frame(temp_frame, paste_frame)
-	return temp_frame
+            FACE_ENHANCER = InferenceSessionPool(NAME, create_session, session_count, runs_per_session)
+    return FACE_ENHANCER
 
-def warp_face(target_face : Face, temp_frame : Frame) -> Tuple[Frame, Matrix]:
-	template = numpy.array(
-	[
-		[ 192.98138, 239.94708 ],
-		[ 318.90277, 240.1936 ],
-		[ 256.63416, 314.01935 ],
-		[ 201.26117, 371.41043 ],
-		[ 313.08905, 371.15118 ]
-	])
-	affine_matrix = cv2.estimateAffinePartial2D(target_face['kps'], template, method = cv2.LMEDS)[0]
-	crop_frame = cv2.warpAffine(temp_frame, affine_matrix, (512, 512))
-	return crop_frame, affine_matrix
-
-
-def paste_back(temp_frame : Frame, crop_frame : Frame, affine_matrix : Matrix) -> Frame:
-	inverse_affine_matrix = cv2.invertAffineTransform(affine_matrix)
-	temp_frame_height, temp_frame_width = temp_frame.shape[0:2]
-	crop_frame_height, crop_frame_width = crop_frame.shape[0:2]
-	inverse_crop_frame = cv2.warpAffine(crop_frame, inverse_affine_matrix, (temp_frame_width, temp_frame_height))
-	inverse_mask = numpy.ones((crop_frame_height, crop_frame_width, 3), dtype = numpy.float32)
-	inverse_mask_frame = cv2.warpAffine(inverse_mask, inverse_affine_matrix, (temp_frame_width, temp_frame_height))
-	inverse_mask_frame = cv2.erode(inverse_mask_frame, numpy.ones((2, 2)))
-	inverse_mask_border = inverse_mask_frame * inverse_crop_frame
-	inverse_mask_area = numpy.sum(inverse_mask_frame) // 3
-	inverse_mask_edge = int(inverse_mask_area ** 0.5) // 20
-	inverse_mask_radius = inverse_mask_edge * 2
-	inverse_mask_center = cv2.erode(inverse_mask_frame, numpy.ones((inverse_mask_radius, inverse_mask_radius)))
-	inverse_mask_blur_size = inverse_mask_edge * 2 + 1
-	inverse_mask_blur_area = cv2.GaussianBlur(inverse_mask_center, (inverse_mask_blur_size, inverse_mask_blur_size), 0)
-	temp_frame = inverse_mask_blur_area * inverse_mask_border + (1 - inverse_mask_blur_area) * temp_frame
-	temp_frame = temp_frame.clip(0, 255).astype(numpy.uint8)
-	return temp_frame
 
+class FaceEnhancerEngine:
+	"""Hold everything the enhancer needs per call so the hot path does no avoidable allocations.
+
+	The warp template, the base crop mask, the erode kernels and the ONNX bindings are
+	created once. Crop, tensor and output buffers are reused per worker thread, and runs
+	are spread over the sessions of the pool.
+	"""
+
+	def __init__(self, session_pool : InferenceSessionPool) -> None:
+		self.session_pool = session_pool
+		session = session_pool.sessions[0]
+		self.template = numpy.array(
+		[
+			[ 192.98138, 239.94708 ],
+			[ 318.90277, 240.1936 ],
+			[ 256.63416, 314.01935 ],
+			[ 201.26117, 371.41043 ],
+			[ 313.08905, 371.15118 ]
+		], dtype = numpy.float32)
+		self.crop_size = (512, 512)
+		self.crop_mask = numpy.ones(self.crop_size, dtype = numpy.float32)
+		self.erode_kernels : Dict[int, Frame] = {}
+		self.input_name = 'input'
+		self.constant_inputs : Dict[str, Frame] = {}
+		for frame_processor_input in session.get_inputs():
+			if frame_processor_input.name == 'weight':
+				self.constant_inputs[frame_processor_input.name] = numpy.array([ 1 ], dtype = numpy.double)
+		self.output_name = session.get_outputs()[0].name
+		output_shape = session.get_outputs()[0].shape
+		# a static output shape lets every thread bind a preallocated output buffer
+		self.output_shape = tuple(output_shape) if all(isinstance(dimension, int) for dimension in output_shape) else None
+		self.thread_local = threading.local()
+
+	def get_buffers(self) -> Any:
+		buffers = self.thread_local
+		if not hasattr(buffers, 'crop_frame'):
+			crop_height, crop_width = self.crop_size
+			buffers.crop_frame = numpy.empty((crop_height, crop_width, 3), dtype = numpy.uint8)
+			buffers.input_tensor = numpy.empty((1, 3, crop_height, crop_width), dtype = numpy.float32)
+			buffers.normalize_frame = numpy.empty((3, crop_height, crop_width), dtype = numpy.float32)
+			buffers.enhance_frame = numpy.empty((crop_height, crop_width, 3), dtype = numpy.uint8)
+			buffers.output_tensor = numpy.empty(self.output_shape, dtype = numpy.float32) if self.output_shape else None
+			buffers.io_bindings = {}
+		return buffers
+
+	def get_io_binding(self, buffers : Any, session_index : int, session : Any) -> Any:
+		# bindings belong to one session, so every thread keeps one per pooled session
+		if session_index not in buffers.io_bindings:
+			io_binding = session.io_binding()
+			io_binding.bind_ortvalue_input(self.input_name, onnxruntime.OrtValue.ortvalue_from_numpy(buffers.input_tensor))
+			for input_name, input_value in self.constant_inputs.items():
+				io_binding.bind_ortvalue_input(input_name, onnxruntime.OrtValue.ortvalue_from_numpy(input_value))
+			io_binding.bind_ortvalue_output(self.output_name, onnxruntime.OrtValue.ortvalue_from_numpy(buffers.output_tensor))
+			buffers.io_bindings[session_index] = io_binding
+		return buffers.io_bindings[session_index]
+
+	def get_erode_kernel(self, kernel_size : int) -> Frame:
+		if kernel_size not in self.erode_kernels:
+			self.erode_kernels[kernel_size] = numpy.ones((kernel_size, kernel_size))
+		return self.erode_kernels[kernel_size]
+
+	def enhance_face(self, target_face : Face, temp_frame : Frame) -> Frame:
+		buffers = self.get_buffers()
+		affine_matrix = self.warp_face(target_face, temp_frame, buffers.crop_frame)
+		self.prepare_crop_frame(buffers.crop_frame, buffers.input_tensor)
+		output_tensor = self.run(buffers)
+		crop_frame = self.normalize_crop_frame(output_tensor[0], buffers.normalize_frame, buffers.enhance_frame)
+		return self.paste_back(temp_frame, crop_frame, affine_matrix)
+
+	def run(self, buffers : Any) -> Frame:
+		with self.session_pool.acquire() as (session_index, session):
+			if buffers.output_tensor is not None:
+				session.run_with_iobinding(self.get_io_binding(buffers, session_index, session))
+				return buffers.output_tensor
+			frame_processor_inputs = { self.input_name: buffers.input_tensor }
+			frame_processor_inputs.update(self.constant_inputs)
+			return session.run([ self.output_name ], frame_processor_inputs)[0]
+
+	def warp_face(self, target_face : Face, temp_frame : Frame, crop_frame : Frame) -> Matrix:
+		affine_matrix = cv2.estimateAffinePartial2D(target_face['kps'], self.template, method = cv2.LMEDS)[0]
+		cv2.warpAffine(temp_frame, affine_matrix, self.crop_size[::-1], dst = crop_frame)
+		return affine_matrix
+
+	def prepare_crop_frame(self, crop_frame : Frame, input_tensor : Frame) -> None:
+		# (bgr[:, :, ::-1] / 255 - 0.5) / 0.5 written channel by channel into the input tensor
+		for channel_index in range(3):
+			numpy.multiply(crop_frame[:, :, 2 - channel_index], 2 / 255.0, out = input_tensor[0, channel_index], casting = 'unsafe')
+		input_tensor -= 1
+
+	def normalize_crop_frame(self, output_frame : Frame, normalize_frame : Frame, enhance_frame : Frame) -> Frame:
+		numpy.clip(output_frame, -1, 1, out = normalize_frame)
+		normalize_frame += 1
+		normalize_frame *= 127.5
+		numpy.rint(normalize_frame, out = normalize_frame)
+		numpy.copyto(enhance_frame, normalize_frame[::-1].transpose(1, 2, 0), casting = 'unsafe')
+		return enhance_frame
+
+	def paste_back(self, temp_frame : Frame, crop_frame : Frame, affine_matrix : Matrix) -> Frame:
+		inverse_affine_matrix = cv2.invertAffineTransform(affine_matrix)
+		paste_region = get_paste_region(temp_frame.shape, crop_frame.shape, inverse_affine_matrix)
+		if paste_region is None:
+			return temp_frame
+		# everything outside the warped crop stays untouched, so only its bounding region is warped and blended
+		left, top, right, bottom = paste_region
+		inverse_affine_matrix[:, 2] -= (left, top)
+		temp_region = temp_frame[top:bottom, left:right]
+		region_height, region_width = temp_region.shape[0:2]
+		inverse_crop_frame = cv2.warpAffine(crop_frame, inverse_affine_matrix, (region_width, region_height))
+		inverse_mask_frame = cv2.warpAffine(self.crop_mask, inverse_affine_matrix, (region_width, region_height))
+		inverse_mask_frame = cv2.erode(inverse_mask_frame, self.get_erode_kernel(2))
+		inverse_mask_area = numpy.sum(inverse_mask_frame)
+		inverse_mask_edge = int(inverse_mask_area ** 0.5) // 20
+		inverse_mask_radius = inverse_mask_edge * 2
+		inverse_mask_center = cv2.erode(inverse_mask_frame, self.get_erode_kernel(inverse_mask_radius))
+		inverse_mask_blur_size = inverse_mask_edge * 2 + 1
+		inverse_mask_blur_area = cv2.GaussianBlur(inverse_mask_center, (inverse_mask_blur_size, inverse_mask_blur_size), 0)
+		inverse_mask_frame = numpy.expand_dims(inverse_mask_frame, axis = 2)
+		inverse_mask_blur_area = numpy.expand_dims(inverse_mask_blur_area, axis = 2)
+		paste_region = inverse_mask_blur_area * (inverse_mask_frame * inverse_crop_frame) + (1 - inverse_mask_blur_area) * temp_region
+		paste_region = paste_region.clip(0, 255).astype(numpy.uint8)
+		temp_frame = temp_frame.copy()
+		temp_frame[top:bottom, left:right] = blend_frame(temp_region, paste_region)
+		return temp_frame
+
+
+def warm_up() -> None:
+    get_face_enhancer()
+
+
+def get_face_enhancer_engine() -> FaceEnhancerEngine:
+	global FACE_ENHANCER_ENGINE
+
+	face_enhancer = get_face_enhancer()
+	with THREAD_LOCK:
+		if FACE_ENHANCER_ENGINE is None:
+			FACE_ENHANCER_ENGINE = FaceEnhancerEngine(face_enhancer)
+	return FACE_ENHANCER_ENGINE
 
-def prepare_crop_frame(crop_frame : Frame) -> Frame:
-	crop_frame = crop_frame[:, :, ::-1] / 255.0
-	crop_frame = (crop_frame - 0.5) / 0.5
-	crop_frame = numpy.expand_dims(crop_frame.transpose(2, 0, 1), axis = 0).astype(numpy.float32)
-	return crop_frame
 
+def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
+	return get_face_enhancer_engine().enhance_face(target_face, temp_frame)
+
+
+def get_paste_region(temp_frame_shape : Tuple[int, ...], crop_frame_shape : Tuple[int, ...], inverse_affine_matrix : Matrix) -> Optional[Tuple[int, int, int, int]]:
+	temp_frame_height, temp_frame_width = temp_frame_shape[0:2]
+	crop_frame_height, crop_frame_width = crop_frame_shape[0:2]
+	crop_corners = numpy.array([[[ 0, 0 ], [ crop_frame_width, 0 ], [ 0, crop_frame_height ], [ crop_frame_width, crop_frame_height ]]], dtype = numpy.float32)
+	paste_corners = cv2.transform(crop_corners, inverse_affine_matrix)[0]
+	# the margin keeps the erode and blur borders of the region identical to the full frame pass
+	paste_area = crop_frame_width * crop_frame_height * abs(numpy.linalg.det(inverse_affine_matrix[:, :2]))
+	paste_margin = int(paste_area ** 0.5) // 20 * 2 + 4
+	left = max(int(numpy.floor(paste_corners[:, 0].min())) - paste_margin, 0)
+	top = max(int(numpy.floor(paste_corners[:, 1].min())) - paste_margin, 0)
+	right = min(int(numpy.ceil(paste_corners[:, 0].max())) + paste_margin, temp_frame_width)
+	bottom = min(int(numpy.ceil(paste_corners[:, 1].max())) + paste_margin, temp_frame_height)
+	if right <= left or bottom <= top:
+		return None
+	return left, top, right, bottom
 
-def normalize_crop_frame(crop_frame : Frame) -> Frame:
-	crop_frame = numpy.clip(crop_frame, -1, 1)
-	crop_frame = (crop_frame + 1) / 2
-	crop_frame = crop_frame.transpose(1, 2, 0)
-	crop_frame = (crop_frame * 255.0).round()
-	crop_frame = crop_frame.astype(numpy.uint8)[:, :, ::-1]
-	return crop_frame
 
 def blend_frame(temp_frame : Frame, paste_frame : Frame) -> Frame:
 	face_enhancer_blend = 1 - (80 / 100)
@@ -15,6 +15,7 @@ FACE_ENHANCER = None
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-ENHANCER'
+FACE_ANALYSER_MODULES = ['detection']
 
 
 def pre_check() -> bool:
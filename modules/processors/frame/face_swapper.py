@@ -1,30 +1,34 @@
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Tuple
 import cv2
 import insightface
+import numpy
 import threading
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
 
 import modules.globals
 import modules.processors.frame.core
+from modules.batch_scheduler import BatchScheduler
+from modules.inference_session import create_inference_session
 from modules.core import update_status
 from modules.face_analyser import get_one_face, get_many_faces
-from modules.typing import Face, Frame
+from modules.source_face_cache import get_source_face, get_source_latent as get_cached_source_latent
+from modules.typing import Face, Frame, Matrix
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
 
 from typing import List
-import onnxruntime
 
 FACE_SWAPPER = None
+SWAP_SCHEDULER = None
+LAST_SWAPS: Dict[int, List[Tuple[Any, Frame]]] = {}
+LAST_SWAPS_LOCK = threading.Lock()
+LAST_SWAPS_SIZE = 8
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-SWAPPER'
-
-def encode_execution_providers(execution_providers: List[str]) -> List[str]:
-    return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
-
-
-def decode_execution_providers(execution_providers: List[str]) -> List[str]:
-    return [provider for provider, encoded_execution_provider in zip(onnxruntime.get_available_providers(), encode_execution_providers(onnxruntime.get_available_providers()))
-            if any(execution_provider in encoded_execution_provider for execution_provider in execution_providers)]
-
+FACE_ANALYSER_MODULES = ['detection', 'recognition']
+NEEDS_SOURCE_FACE = True
+SUPPORTS_REUSE = True
+MODEL_NAME = 'inswapper_128_fp16'
 
 def pre_check() -> bool:
     download_directory_path = resolve_relative_path('../models')
@@ -36,7 +40,7 @@ def pre_start() -> bool:
     if not is_image(modules.globals.source_path):
         update_status('Select an image for source path.', NAME)
         return False
-    elif not get_one_face(cv2.imread(modules.globals.source_path)):
+    elif not get_source_face(modules.globals.source_path):
         update_status('No face in source path detected.', NAME)
         return False
     if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
@@ -50,14 +54,141 @@ def get_face_swapper() -> Any:
 
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128_fp16.onnx')
+            model_path = resolve_relative_path('../models/' + MODEL_NAME + '.onnx')
             # FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.globals.execution_providers)
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path,  providers=decode_execution_providers(["cuda"]))
+            # the emap is still read from the original model, only the session runs the cached optimized one
+            FACE_SWAPPER = INSwapper(model_file=model_path, session=create_inference_session(model_path))
     return FACE_SWAPPER
 
 
+def warm_up() -> None:
+    get_face_swapper()
+
+
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    crop_frame, affine_matrix = warp_face(target_face, temp_frame)
+    swap_frame = run_swap([crop_frame], get_source_latent(source_face))[0]
+    return paste_back(temp_frame, crop_frame, swap_frame, affine_matrix)
+
+
+def get_face_center(target_face: Face) -> Any:
+    return numpy.mean(target_face.kps, axis=0)
+
+
+def set_last_swap_frames(sequence: int, target_faces: List[Face], swap_frames: List[Frame]) -> None:
+    # worker threads finish out of order, the swaps are kept by the stream sequence of their frame
+    with LAST_SWAPS_LOCK:
+        LAST_SWAPS[sequence] = [(get_face_center(target_face), swap_frame) for target_face, swap_frame in zip(target_faces, swap_frames)]
+        while len(LAST_SWAPS) > LAST_SWAPS_SIZE:
+            del LAST_SWAPS[min(LAST_SWAPS)]
+
+
+def clear_reuse_state() -> None:
+    with LAST_SWAPS_LOCK:
+        LAST_SWAPS.clear()
+
+
+def get_last_swap_frames(sequence: int) -> List[Tuple[Any, Frame]]:
+    # the newest swap before the frame, a later one only when nothing earlier is left
+    with LAST_SWAPS_LOCK:
+        if not LAST_SWAPS:
+            return []
+        earlier_sequences = [swap_sequence for swap_sequence in LAST_SWAPS if swap_sequence < sequence]
+        if earlier_sequences:
+            return LAST_SWAPS[max(earlier_sequences)]
+        return LAST_SWAPS[min(LAST_SWAPS)]
+
+
+def get_source_latent(source_face: Face) -> Any:
+    return get_cached_source_latent(source_face, MODEL_NAME, compute_source_latent)
+
+
+def compute_source_latent(source_face: Face) -> Any:
+    face_swapper = get_face_swapper()
+    latent = source_face.normed_embedding.reshape((1, -1))
+    latent = numpy.dot(latent, face_swapper.emap)
+    latent /= numpy.linalg.norm(latent)
+    return latent
+
+
+def supports_batch() -> bool:
+    batch_dimension = get_face_swapper().session.get_inputs()[0].shape[0]
+    return not isinstance(batch_dimension, int) or batch_dimension != 1
+
+
+def warp_face(target_face: Face, temp_frame: Frame) -> Tuple[Frame, Matrix]:
+    return face_align.norm_crop2(temp_frame, target_face.kps, get_face_swapper().input_size[0])
+
+
+def get_swap_scheduler() -> BatchScheduler:
+    global SWAP_SCHEDULER
+
+    with THREAD_LOCK:
+        if SWAP_SCHEDULER is None:
+            SWAP_SCHEDULER = BatchScheduler('face_swapper', run_swap_requests, max_batch_size=modules.globals.face_swapper_batch_size, max_wait=modules.globals.batch_max_wait)
+    return SWAP_SCHEDULER
+
+
+def run_swap(crop_frames: List[Frame], source_latent: Any) -> List[Frame]:
+    if modules.globals.batch_scheduler:
+        # crops of every in-flight frame and stream share the inference runs
+        return get_swap_scheduler().map([(crop_frame, source_latent) for crop_frame in crop_frames])
+    return swap_crop_frames(crop_frames, numpy.repeat(source_latent, len(crop_frames), axis=0))
+
+
+def run_swap_requests(swap_requests: List[Tuple[Frame, Any]]) -> List[Frame]:
+    return swap_crop_frames([crop_frame for crop_frame, _ in swap_requests], numpy.concatenate([source_latent for _, source_latent in swap_requests]))
+
+
+def swap_crop_frames(crop_frames: List[Frame], source_latents: Any) -> List[Frame]:
+    face_swapper = get_face_swapper()
+    input_mean = (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean)
+    blob = cv2.dnn.blobFromImages(crop_frames, 1.0 / face_swapper.input_std, face_swapper.input_size, input_mean, swapRB=True)
+    if supports_batch():
+        batch_size = max(1, modules.globals.face_swapper_batch_size)
+        predictions = []
+        for index in range(0, len(crop_frames), batch_size):
+            target_blob = blob[index:index + batch_size]
+            source_blob = source_latents[index:index + batch_size]
+            predictions.append(face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: target_blob, face_swapper.input_names[1]: source_blob})[0])
+        prediction = numpy.concatenate(predictions)
+    else:
+        # models exported with a fixed batch size of one still share the preprocessing
+        prediction = numpy.concatenate([face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob[index:index + 1], face_swapper.input_names[1]: source_latents[index:index + 1]})[0] for index in range(len(crop_frames))])
+    swap_frames = numpy.clip(255 * prediction.transpose((0, 2, 3, 1)), 0, 255).astype(numpy.uint8)[:, :, :, ::-1]
+    return list(swap_frames)
+
+
+def paste_back(temp_frame: Frame, crop_frame: Frame, swap_frame: Frame, affine_matrix: Matrix) -> Frame:
+    # mirrors the paste back of insightface.model_zoo.inswapper.INSwapper.get
+    temp_frame_height, temp_frame_width = temp_frame.shape[0:2]
+    inverse_affine_matrix = cv2.invertAffineTransform(affine_matrix)
+    inverse_mask = numpy.full((crop_frame.shape[0], crop_frame.shape[1]), 255, dtype=numpy.float32)
+    inverse_swap_frame = cv2.warpAffine(swap_frame, inverse_affine_matrix, (temp_frame_width, temp_frame_height), borderValue=0.0)
+    inverse_mask = cv2.warpAffine(inverse_mask, inverse_affine_matrix, (temp_frame_width, temp_frame_height), borderValue=0.0)
+    inverse_mask[inverse_mask > 20] = 255
+    mask_height_indices, mask_width_indices = numpy.where(inverse_mask == 255)
+    if not len(mask_height_indices):
+        return temp_frame
+    mask_height = numpy.max(mask_height_indices) - numpy.min(mask_height_indices)
+    mask_width = numpy.max(mask_width_indices) - numpy.min(mask_width_indices)
+    mask_size = int(numpy.sqrt(mask_height * mask_width))
+    erode_size = max(mask_size // 10, 10)
+    inverse_mask = cv2.erode(inverse_mask, numpy.ones((erode_size, erode_size), numpy.uint8), iterations=1)
+    blur_size = 2 * max(mask_size // 20, 5) + 1
+    inverse_mask = cv2.GaussianBlur(inverse_mask, (blur_size, blur_size), 0)
+    inverse_mask = (inverse_mask / 255).reshape((temp_frame_height, temp_frame_width, 1))
+    temp_frame = inverse_mask * inverse_swap_frame + (1 - inverse_mask) * temp_frame.astype(numpy.float32)
+    return temp_frame.astype(numpy.uint8)
+
+
+def get_target_faces(temp_frame: Frame) -> List[Face]:
+    if modules.globals.many_faces:
+        return get_many_faces(temp_frame) or []
+    target_face = get_one_face(temp_frame)
+    if target_face:
+        return [target_face]
+    return []
 
 
 def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
@@ -73,8 +204,47 @@ def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
     return temp_frame
 
 
+def process_frame_batch(source_face: Face, temp_frames: List[Frame], sequences: Optional[List[int]] = None) -> List[Frame]:
+    frame_indices = []
+    target_faces = []
+    for frame_index, temp_frame in enumerate(temp_frames):
+        for target_face in get_target_faces(temp_frame):
+            frame_indices.append(frame_index)
+            target_faces.append((target_face, temp_frame))
+    if not target_faces:
+        return list(temp_frames)
+    crops = [warp_face(target_face, temp_frame) for target_face, temp_frame in target_faces]
+    swap_frames = run_swap([crop_frame for crop_frame, _ in crops], get_source_latent(source_face))
+    result_frames = list(temp_frames)
+    if sequences:
+        last_swaps = [(target_face, swap_frame) for frame_index, (target_face, _), swap_frame in zip(frame_indices, target_faces, swap_frames) if frame_index == frame_indices[-1]]
+        set_last_swap_frames(sequences[frame_indices[-1]], [target_face for target_face, _ in last_swaps], [swap_frame for _, swap_frame in last_swaps])
+    # faces of the same frame are pasted one after another onto the frame
+    for frame_index, (crop_frame, affine_matrix), swap_frame in zip(frame_indices, crops, swap_frames):
+        result_frames[frame_index] = paste_back(result_frames[frame_index], crop_frame, swap_frame, affine_matrix)
+    return result_frames
+
+
+def reuse_frame(source_face: Face, temp_frame: Frame, sequence: Optional[int] = None) -> Frame:
+    # paste the last swapped faces onto the current landmarks instead of running the model
+    if sequence is None:
+        return temp_frame
+    last_swaps = get_last_swap_frames(sequence)
+    if not last_swaps:
+        return temp_frame
+    for target_face in get_target_faces(temp_frame):
+        # each face takes the swap of the nearest face, a face that moved further than its own size is left as it is
+        face_center = get_face_center(target_face)
+        distance, swap_frame = min(((numpy.linalg.norm(face_center - swap_center), swap_frame) for swap_center, swap_frame in last_swaps), key=lambda last_swap: last_swap[0])
+        if distance > target_face.bbox[2] - target_face.bbox[0]:
+            continue
+        affine_matrix = face_align.estimate_norm(target_face.kps, swap_frame.shape[0])
+        temp_frame = paste_back(temp_frame, swap_frame, swap_frame, affine_matrix)
+    return temp_frame
+
+
 def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
+    source_face = get_source_face(source_path)
     for temp_frame_path in temp_frame_paths:
         temp_frame = cv2.imread(temp_frame_path)
         try:
@@ -88,7 +258,7 @@ def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any
 
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
-    source_face = get_one_face(cv2.imread(source_path))
+    source_face = get_source_face(source_path)
     target_frame = cv2.imread(target_path)
     result = process_frame(source_face, target_frame)
     cv2.imwrite(output_path, result)
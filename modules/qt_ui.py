@@ -331,7 +331,7 @@ def push_frames(frame_queue, processed_frame, frame_processors, source_image):
         if frame is None:
             break
         processed_frame = process_single_frame(frame, frame_processors, source_image)
-        push_process.stdin.write(processed_frame.tobytes())
+        push_process.stdin.write(processed_frame)
     push_process.stdin.close()
     push_process.wait()
     
@@ -371,7 +371,7 @@ def webcam_preview():
             processed_frames = process_frames(frame_buffer, frame_processors, source_image)
             
             for processed_frame in processed_frames:
-                push_process.stdin.write(processed_frame.tobytes())
+                push_process.stdin.write(processed_frame)
 
             frame_buffer = []  # Clear buffer after processing
 
@@ -389,7 +389,7 @@ def webcam_preview():
     if frame_buffer:
         processed_frames = process_frames(frame_buffer, frame_processors, source_image)
         for processed_frame in processed_frames:
-            push_process.stdin.write(processed_frame.tobytes())
+            push_process.stdin.write(processed_frame)
 
     cap.release()
     push_process.stdin.close()
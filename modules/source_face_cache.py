@@ -0,0 +1,96 @@
+import hashlib
+import io
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import cv2
+import numpy
+
+from modules.face_analyser import get_face_analyser_modules, get_face_detector_size, get_one_face
+from modules.typing import Face
+from modules.utilities import resolve_relative_path
+
+SOURCE_FACE_CACHE_DIRECTORY = resolve_relative_path('../.caches/source_faces')
+SOURCE_FACE_KEYS = ['bbox', 'kps', 'det_score', 'embedding']
+SOURCE_FACES: Dict[str, Optional[Face]] = {}
+SOURCE_FACE_HASHES: Dict[Tuple[str, float, int], str] = {}
+THREAD_LOCK = threading.RLock()
+
+
+def get_source_hash(source_path: str) -> str:
+    source_stat = os.stat(source_path)
+    hash_key = (os.path.abspath(source_path), source_stat.st_mtime, source_stat.st_size)
+    if hash_key not in SOURCE_FACE_HASHES:
+        with open(source_path, 'rb') as source_file:
+            SOURCE_FACE_HASHES[hash_key] = hashlib.sha256(source_file.read()).hexdigest()
+    return SOURCE_FACE_HASHES[hash_key]
+
+
+def get_cache_key(source_hash: str) -> str:
+    # the analysed attributes depend on the loaded analyser modules and the detector size
+    analyser_key = repr((get_face_analyser_modules(), get_face_detector_size()))
+    return source_hash + '-' + hashlib.sha256(analyser_key.encode()).hexdigest()[:16]
+
+
+def get_cache_path(cache_key: str) -> str:
+    return os.path.join(SOURCE_FACE_CACHE_DIRECTORY, cache_key + '.npz')
+
+
+def read_cache(cache_key: str) -> Optional[Face]:
+    cache_path = get_cache_path(cache_key)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with numpy.load(cache_path) as cache:
+            source_face = Face({ key: cache[key] for key in SOURCE_FACE_KEYS if key in cache.files })
+            source_face.latents = { key[len('latent_'):]: cache[key] for key in cache.files if key.startswith('latent_') }
+    except Exception as exception:
+        print(f'Ignoring unreadable source face cache {cache_path}: {exception}')
+        return None
+    source_face.cache_key = cache_key
+    return source_face
+
+
+def write_cache(source_face: Face) -> None:
+    arrays = { key: numpy.asarray(source_face[key]) for key in SOURCE_FACE_KEYS if source_face.get(key) is not None }
+    for model_name, latent in source_face.latents.items():
+        arrays['latent_' + model_name] = latent
+    cache_path = get_cache_path(source_face.cache_key)
+    os.makedirs(SOURCE_FACE_CACHE_DIRECTORY, exist_ok=True)
+    buffer = io.BytesIO()
+    numpy.savez(buffer, **arrays)
+    # write to a temporary file first so concurrent readers never see a partial cache
+    temp_cache_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_cache_path, 'wb') as cache_file:
+        cache_file.write(buffer.getvalue())
+    os.replace(temp_cache_path, cache_path)
+
+
+def get_source_face(source_path: str) -> Optional[Face]:
+    with THREAD_LOCK:
+        cache_key = get_cache_key(get_source_hash(source_path))
+        if cache_key not in SOURCE_FACES:
+            source_face = read_cache(cache_key)
+            if source_face is None:
+                source_face = get_one_face(cv2.imread(source_path))
+                if source_face:
+                    source_face.cache_key = cache_key
+                    source_face.latents = {}
+                    write_cache(source_face)
+            SOURCE_FACES[cache_key] = source_face
+        return SOURCE_FACES[cache_key]
+
+
+def get_source_latent(source_face: Face, model_name: str, compute_latent: Callable[[Face], Any]) -> Any:
+    latents = source_face.get('latents')
+    if latents is not None and model_name in latents:
+        return latents[model_name]
+    with THREAD_LOCK:
+        if source_face.get('latents') is None:
+            source_face.latents = {}
+        if model_name not in source_face.latents:
+            source_face.latents[model_name] = compute_latent(source_face)
+            if source_face.get('cache_key'):
+                write_cache(source_face)
+        return source_face.latents[model_name]
@@ -0,0 +1,158 @@
+import collections
+import os
+import threading
+import time
+from modules.logger import logger
+
+TS_PACKET_SIZE = 188
+PTS_CLOCK_RATE = 90000
+
+
+def read_pes_pts(data):
+    """Return the pts in seconds of the first PES header in the transport stream packets, None without one."""
+    for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        # Only packets that start a payload carry a PES header
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        adaptation_field_control = (packet[3] >> 4) & 0x03
+        if not adaptation_field_control & 0x01:
+            continue
+        payload_offset = 4
+        if adaptation_field_control & 0x02:
+            payload_offset += 1 + packet[4]
+        payload = packet[payload_offset:]
+        # PAT and PMT sections have no start code, and the pts flag must be set
+        if len(payload) < 14 or payload[:3] != b'\x00\x00\x01' or not payload[7] & 0x80:
+            continue
+        pts = ((payload[9] >> 1) & 0x07) << 30 | payload[10] << 22 | (payload[11] >> 1) << 15 | payload[12] << 7 | payload[13] >> 1
+        return pts / PTS_CLOCK_RATE
+    return None
+
+
+class AudioRelayThread(threading.Thread):
+    """Pass the decoder's audio on to the muxer as soon as it arrives.
+
+    Reads the mpegts audio teed by FFmpegCapture and writes it to ``output_fd``
+    from a separate writer thread, so neither the decoder nor the video writes
+    wait on the muxer reading its audio. When the muxer falls behind, chunks
+    older than ``max_buffer_seconds`` are dropped. The pts of the first audio
+    handed to the muxer is kept in ``first_pts``, the muxer offsets the audio
+    input by it against the first frame pts, so the sync follows the source
+    timestamps instead of arrival times.
+    """
+
+    def __init__(self, input_fd, max_buffer_seconds=30, read_size=TS_PACKET_SIZE * 348):
+        super().__init__(daemon=True)
+        self.input_fd = input_fd
+        self.max_buffer_seconds = max_buffer_seconds
+        self.read_size = read_size
+        self.output_fd, self._write_fd = os.pipe()
+        self._chunks = collections.deque()
+        self.first_pts = None
+        self._first_pts_event = threading.Event()
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name=self.__class__.__name__ + 'Writer', daemon=True)
+        self.dropped_chunks = 0
+
+        self.name = self.__class__.__name__
+
+        logger.info(
+            f"Initialized {self.name}, "
+            f"Max Buffer Seconds: {self.max_buffer_seconds}, "
+            f"Read Size: {self.read_size}"
+        )
+
+    def start(self):
+        super().start()
+        self._writer.start()
+
+    def run(self):
+        remainder = b''
+        while not self._stop_event.is_set():
+            try:
+                data = os.read(self.input_fd, self.read_size)
+            except OSError as e:
+                logger.info(f"{self.name} input closed: {e}")
+                break
+            if not data:
+                logger.info(f"{self.name} reached the end of the audio stream")
+                break
+
+            # Keep whole transport stream packets together so a trimmed buffer stays demuxable
+            data = remainder + data
+            aligned_size = len(data) - len(data) % TS_PACKET_SIZE
+            remainder = data[aligned_size:]
+            if not aligned_size:
+                continue
+
+            arrival_time = time.monotonic()
+            with self._condition:
+                self._chunks.append((arrival_time, data[:aligned_size]))
+                while self._chunks and arrival_time - self._chunks[0][0] > self.max_buffer_seconds:
+                    self._chunks.popleft()
+                    self.dropped_chunks += 1
+                    if self.dropped_chunks % 100 == 1:
+                        logger.warning(f"{self.name} dropped {self.dropped_chunks} audio chunks, the muxer is more than {self.max_buffer_seconds} seconds behind")
+                self._condition.notify()
+
+    def wait_first_pts(self, timeout=None):
+        """Return the pts in seconds of the first audio written to the muxer, None if none arrived within the timeout."""
+        self._first_pts_event.wait(timeout)
+        return self.first_pts
+
+    def _write_loop(self):
+        while not self._stop_event.is_set():
+            with self._condition:
+                while not self._stop_event.is_set() and not self._chunks:
+                    self._condition.wait(timeout=0.5)
+                if self._stop_event.is_set():
+                    break
+                _, data = self._chunks.popleft()
+
+            if self.first_pts is None:
+                # The muxer starts its audio input at the first pts it reads
+                self.first_pts = read_pes_pts(data)
+                if self.first_pts is not None:
+                    self._first_pts_event.set()
+
+            view = memoryview(data)
+            try:
+                while view:
+                    written = os.write(self._write_fd, view)
+                    view = view[written:]
+            except OSError as e:
+                logger.info(f"{self.name} muxer closed the audio pipe: {e}")
+                break
+
+    @property
+    def buffered_seconds(self):
+        with self._condition:
+            if not self._chunks:
+                return 0.0
+            return self._chunks[-1][0] - self._chunks[0][0]
+
+    def stop(self):
+        if self._stop_event.is_set():
+            return
+        logger.info(
+            f"Stop AudioRelayThread: "
+            f"Thread Name: {self.name}, "
+            f"Dropped Chunks: {self.dropped_chunks}"
+        )
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify_all()
+        # Once the muxer has exited, closing our read end turns a blocked write into a broken pipe
+        self._close_fd(self.output_fd)
+        if self._writer.is_alive():
+            self._writer.join(timeout=1)
+        self._close_fd(self._write_fd)
+
+    @staticmethod
+    def _close_fd(fd):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
@@ -0,0 +1,228 @@
+import io
+import json
+import os
+import re
+import subprocess
+import threading
+import cv2
+import numpy
+from modules.logger import logger
+
+SHOWINFO_PTS_TIME = re.compile(rb'Parsed_showinfo.*?\bn:\s*([0-9]+).*?\bpts_time:\s*(-?[0-9.]+)')
+
+
+class FFmpegCapture:
+    """Decode a stream with one ffmpeg process and read raw bgr24 frames from its stdout.
+
+    Exposes the subset of the cv2.VideoCapture interface the live pipeline uses
+    (isOpened, read, get, release), so it can be handed to FrameCaptureThread in
+    place of OpenCV. With ``audio=True`` the same decoder also copies the first
+    audio stream as mpegts to a pipe, its read end is ``audio_fd``, so the muxer
+    can take the audio without fetching the source a second time.
+
+    Frame timestamps are taken from a showinfo filter on the decoder's stderr,
+    they are matched to the frames on stdout by their frame index and reported through
+    ``get(cv2.CAP_PROP_POS_MSEC)`` like OpenCV does.
+    """
+
+    def __init__(self, input_url, threads=0, hwaccel=None, scale=None, low_delay=True, audio=False):
+        self.input_url = input_url
+        self.threads = threads
+        self.hwaccel = hwaccel
+        self.low_delay = low_delay
+        self.process = None
+        self.audio_fd = None
+        self.width = 0
+        self.height = 0
+        self.fps = 0
+        self.has_audio = False
+        self.frame_count = 0
+        self.position = 0.0
+        # showinfo frame index -> pts_time, entries of frames already read are dropped
+        self._pts_times = {}
+        self._pts_condition = threading.Condition()
+        self._stderr_thread = None
+
+        if not self._probe():
+            return
+        if scale:
+            self.width, self.height = (int(value) for value in scale.split('x'))
+        self.frame_size = self.width * self.height * 3
+        self._start(audio and self.has_audio)
+
+        logger.info(
+            f"Initialized FFmpegCapture, "
+            f"Input: {self.input_url}, "
+            f"Frame Size: {self.width}x{self.height}, "
+            f"FPS: {self.fps}, "
+            f"Threads: {self.threads}, "
+            f"HW Accel: {self.hwaccel}, "
+            f"Audio: {self.audio_fd is not None}"
+        )
+
+    def _probe(self):
+        """Read the frame size, frame rate and audio presence of the input with ffprobe."""
+        ffprobe_command = [
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries', 'stream=codec_type,width,height,avg_frame_rate,r_frame_rate',
+            '-of', 'json',
+            self.input_url
+        ]
+        try:
+            output = subprocess.run(ffprobe_command, capture_output=True, timeout=30, check=True).stdout
+            streams = json.loads(output).get('streams', [])
+        except Exception as e:
+            logger.error(f"FFmpegCapture failed to probe {self.input_url}: {e}")
+            return False
+
+        video_streams = [stream for stream in streams if stream.get('codec_type') == 'video']
+        if not video_streams:
+            logger.error(f"FFmpegCapture found no video stream in {self.input_url}")
+            return False
+        video_stream = video_streams[0]
+        self.width = int(video_stream['width'])
+        self.height = int(video_stream['height'])
+        self.fps = self._parse_frame_rate(video_stream.get('avg_frame_rate')) or self._parse_frame_rate(video_stream.get('r_frame_rate'))
+        self.has_audio = any(stream.get('codec_type') == 'audio' for stream in streams)
+        return True
+
+    @staticmethod
+    def _parse_frame_rate(frame_rate):
+        try:
+            numerator, denominator = (int(value) for value in frame_rate.split('/'))
+            return numerator / denominator if denominator else 0
+        except (AttributeError, ValueError):
+            return 0
+
+    def build_command(self, audio_write_fd=None):
+        ffmpeg_command = ['ffmpeg', '-nostdin', '-hide_banner']
+        if self.low_delay:
+            ffmpeg_command += ['-fflags', 'nobuffer', '-flags', 'low_delay']
+        if self.threads:
+            ffmpeg_command += ['-threads', str(self.threads)]
+        if self.hwaccel:
+            ffmpeg_command += ['-hwaccel', self.hwaccel]
+        if audio_write_fd is not None:
+            # Frame pts and audio pts both stay on the source clock, the muxer aligns them by it
+            ffmpeg_command += ['-copyts']
+        ffmpeg_command += ['-i', self.input_url]
+
+        ffmpeg_command += ['-map', '0:v:0']
+        ffmpeg_command += ['-vf', f'scale={self.width}:{self.height},showinfo']
+        ffmpeg_command += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+
+        if audio_write_fd is not None:
+            # Copy the audio untouched, without a mux delay the mpegts pts are the source pts
+            ffmpeg_command += ['-map', '0:a:0', '-c:a', 'copy', '-muxdelay', '0', '-muxpreload', '0', '-f', 'mpegts', f'pipe:{audio_write_fd}']
+        return ffmpeg_command
+
+    def _start(self, audio):
+        audio_write_fd = None
+        if audio:
+            self.audio_fd, audio_write_fd = os.pipe()
+        try:
+            # Unbuffered stdout, frames are read straight into the caller's buffers
+            self.process = subprocess.Popen(
+                self.build_command(audio_write_fd),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,
+                pass_fds=(audio_write_fd,) if audio_write_fd is not None else ()
+            )
+            self._stderr_thread = threading.Thread(target=self._read_stderr, name='FFmpegCaptureStderr', daemon=True)
+            self._stderr_thread.start()
+        except Exception as e:
+            logger.error(f"FFmpegCapture failed to start the decoder: {e}")
+            self.process = None
+            self._close_audio_fd()
+        finally:
+            if audio_write_fd is not None:
+                os.close(audio_write_fd)
+
+    def _read_stderr(self):
+        """Collect the showinfo frame timestamps and log everything else."""
+        stderr = self.process.stderr
+        with io.open('logs/ffmpeg_capture.log', 'w', buffering=1) as log_file:
+            for line in iter(stderr.readline, b''):
+                match = SHOWINFO_PTS_TIME.search(line)
+                if match:
+                    with self._pts_condition:
+                        self._pts_times[int(match.group(1))] = float(match.group(2))
+                        self._pts_condition.notify()
+                elif b'Parsed_showinfo' not in line:
+                    log_file.write(line.decode('utf-8', 'replace'))
+        with self._pts_condition:
+            self._pts_condition.notify_all()
+
+    def _next_position(self, frame_index):
+        """Timestamp of the frame just read, its showinfo line is usually written before the frame itself."""
+        with self._pts_condition:
+            if frame_index not in self._pts_times:
+                self._pts_condition.wait_for(lambda: frame_index in self._pts_times or self.process.poll() is not None, timeout=0.1)
+            pts_time = self._pts_times.pop(frame_index, None)
+            # a line that arrives after its frame fell back to the frame rate must not be used for a later frame
+            for stale_index in [index for index in self._pts_times if index < frame_index]:
+                del self._pts_times[stale_index]
+            if pts_time is not None:
+                return pts_time
+        # No timestamp arrived, assume a constant frame rate from the last known one
+        return self.position + 1 / (self.fps or 25)
+
+    def isOpened(self):
+        return self.process is not None and self.process.poll() is None
+
+    def read(self, image=None):
+        """Read the next frame, into ``image`` when it has the decoded shape. Returns (ret, frame)."""
+        if self.process is None:
+            return False, None
+        if image is None or image.shape != (self.height, self.width, 3) or image.dtype != numpy.uint8 or not image.flags['C_CONTIGUOUS']:
+            image = numpy.empty((self.height, self.width, 3), dtype=numpy.uint8)
+
+        view = memoryview(image).cast('B')
+        filled = 0
+        while filled < self.frame_size:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                return False, None
+            filled += count
+        self.position = self._next_position(self.frame_count)
+        self.frame_count += 1
+        return True, image
+
+    def get(self, prop_id):
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop_id == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop_id == cv2.CAP_PROP_POS_MSEC:
+            return self.position * 1000
+        if prop_id == cv2.CAP_PROP_POS_FRAMES:
+            return self.frame_count
+        return 0
+
+    def _close_audio_fd(self):
+        if self.audio_fd is not None:
+            try:
+                os.close(self.audio_fd)
+            except OSError:
+                pass
+            self.audio_fd = None
+
+    def release(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdout.close()
+            self.process.terminate()
+            self.process.wait(timeout=3)
+        except subprocess.TimeoutExpired:
+            logger.warning("Timeout waiting for FFmpegCapture decoder to end, killing it")
+            self.process.kill()
+        except Exception as e:
+            logger.warning(f"Exception while releasing FFmpegCapture: {e}")
+        finally:
+            self.process = None
+            self._close_audio_fd()
@@ -3,18 +3,50 @@ from modules.logger import logger
 import time
 import threading
 import io
+import os
+import numpy
 
 class FFmpegStreamerProcess:
-    def __init__(self, width, height, fps, input_rtmp_url, output_rtmp_url):
+    def __init__(self, width, height, fps, input_rtmp_url, output_rtmp_url, audio_fd=None, single_ingest=False, audio_start_pts=None):
         self.width = width
         self.height = height
         self.fps = fps
         self.input_rtmp_url = input_rtmp_url
         self.output_rtmp_url = output_rtmp_url
+        # Readable fd carrying the source audio as mpegts, e.g. teed by FFmpegCapture
+        self.audio_fd = audio_fd
+        # Callable returning the pts of the first audio on audio_fd, the audio is offset by it against the first frame
+        self.audio_start_pts = audio_start_pts
+        # With audio_start_pts FFmpeg is launched on the first frame, once both start pts are known
+        self.start_pending = False
+        # Never open the input url here, the audio comes from audio_fd or the output has none
+        self.single_ingest = single_ingest
         self.process = None
+        # Output timeline, frames with a pts are placed on the -r fps grid starting at the first one
+        self.pts_origin = None
+        self.next_slot = 0
+        self.duplicated_frames = 0
+        self.dropped_frames = 0
+        # Wall clock time of the first frame handed to FFmpeg, the stream is live again from here
+        self.first_frame_time = None
 
     def start(self):
         """Start the FFmpeg process for streaming."""
+        if self.audio_fd is not None and self.audio_start_pts is not None:
+            self.start_pending = True
+            logger.info(f"FFmpegStreamer Process waits for the first frame to align the audio: {self.output_rtmp_url}")
+            return
+        self._start_process()
+
+    def get_audio_offset(self, timeout=1.0):
+        """Seconds the audio input starts after the first frame on the source clock."""
+        audio_pts = self.audio_start_pts(timeout)
+        if audio_pts is None or self.pts_origin is None:
+            logger.warning("FFmpegStreamer has no start pts for the audio or the video, the audio is not offset")
+            return 0.0
+        return audio_pts - self.pts_origin
+
+    def _start_process(self, audio_offset=None):
         ffmpeg_command = [
             'ffmpeg',
             '-y',
@@ -24,8 +56,30 @@ class FFmpegStreamerProcess:
             '-s', f'{self.width}x{self.height}',
             '-r', str(self.fps),
             '-i', '-',
-            '-itsoffset', '10',  # 延迟音频
-            '-i', self.input_rtmp_url,
+        ]
+        if self.audio_fd is not None:
+            # The relay writes the audio as it arrives, a short probe is enough
+            ffmpeg_command += [
+                '-fflags', 'nobuffer',
+                '-probesize', '32768',
+                '-analyzeduration', '500000',
+            ]
+            if audio_offset:
+                ffmpeg_command += ['-itsoffset', f'{audio_offset:.3f}']
+            ffmpeg_command += [
+                '-f', 'mpegts',
+                '-i', f'pipe:{self.audio_fd}',
+                '-map', '0:v:0',
+                '-map', '1:a:0',
+            ]
+        elif self.single_ingest:
+            ffmpeg_command += ['-map', '0:v:0']
+        else:
+            ffmpeg_command += [
+                '-itsoffset', '10',  # 延迟音频
+                '-i', self.input_rtmp_url,
+            ]
+        ffmpeg_command += [
             '-c:v', 'h264_nvenc',
             '-c:a', 'aac',
             '-b:a', '128k',
@@ -37,18 +91,28 @@ class FFmpegStreamerProcess:
             '-af', 'aresample=async=1',  # Resample audio
             '-shortest',
             '-max_interleave_delta', '100M',
-            '-probesize', '100M',
-            '-analyzeduration', '100M',
-            self.output_rtmp_url
         ]
+        if not self.single_ingest and self.audio_fd is None:
+            ffmpeg_command += [
+                '-probesize', '100M',
+                '-analyzeduration', '100M',
+            ]
+        ffmpeg_command += [self.output_rtmp_url]
         
-        self.process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, stderr=io.open('logs/ffmpeg.log', 'w', buffering=1))
+        # Unbuffered stdin, frames are written straight to the pipe fd without an intermediate copy
+        self.process = subprocess.Popen(
+            ffmpeg_command,
+            stdin=subprocess.PIPE,
+            stderr=io.open('logs/ffmpeg.log', 'w', buffering=1),
+            bufsize=0,
+            pass_fds=(self.audio_fd,) if self.audio_fd is not None else ()
+        )
         
         # Start a thread to read stderr
         # self.stderr_thread = threading.Thread(target=self._read_stderr)
         # self.stderr_thread.start()
         
-        logger.info(f"Started FFmpegStreamer Process: {self.output_rtmp_url}")
+        logger.info(f"Started FFmpegStreamer Process: {self.output_rtmp_url}, Audio Offset: {audio_offset}")
 
     def _read_stderr(self):
         """Continuously read from stderr."""
@@ -62,6 +126,7 @@ class FFmpegStreamerProcess:
                 
     def stop(self):
         """Stop the FFmpeg process."""
+        self.start_pending = False
         if self.process is None:
             logger.info("FFmpegStreamer Process is None")
             return
@@ -90,6 +155,8 @@ class FFmpegStreamerProcess:
         
         # if not self.running:
         #     return False
+        if self.start_pending:
+            return True
         if self.process is None:
             return False
         # poll() returns None if the process is still running
@@ -103,23 +170,66 @@ class FFmpegStreamerProcess:
 
     def send_frame(self, frame):
         """Send a video frame to the FFmpeg process."""
+        if self.start_pending:
+            self.start_pending = False
+            self._start_process(self.get_audio_offset())
         if self.process and self.is_running():
-            self.process.stdin.write(frame)
+            self._write_frame(frame)
+            if self.first_frame_time is None:
+                self.first_frame_time = time.time()
             return True
 
         else:
             logger.error("FFmpegStreamer process is not running or not ready to receive frames.")
             return False
 
-    def send_frame_with_retry(self, frame, retry_count=3):
-        """Push the frame to FFmpeg with retry mechanism."""
+    def _write_frame(self, frame):
+        """Write the frame memory to the pipe without converting it to bytes first."""
+        if not frame.flags['C_CONTIGUOUS']:
+            frame = numpy.ascontiguousarray(frame)
+        view = memoryview(frame).cast('B')
+        fd = self.process.stdin.fileno()
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def get_frame_repeats(self, pts, max_gap=2.0):
+        """Number of times the frame must be written so it lands on its slot of the constant rate output.
+
+        0 drops a frame whose slot has already been written, more than 1 fills the
+        slots of frames that were dropped before it. A gap longer than ``max_gap``
+        seconds is a timestamp jump of the source, the timeline is rebased on it.
+        """
+        if pts is None:
+            return 1
+        if self.pts_origin is None:
+            self.pts_origin = pts
+        slot = round((pts - self.pts_origin) * self.fps)
+        if slot - self.next_slot > max_gap * self.fps or slot < self.next_slot - max_gap * self.fps:
+            logger.warning(f"FFmpegStreamer timestamp jump of {(slot - self.next_slot) / self.fps:.2f} seconds, rebasing the timeline")
+            self.pts_origin = pts - self.next_slot / self.fps
+            slot = self.next_slot
+        if slot < self.next_slot:
+            self.dropped_frames += 1
+            return 0
+        repeats = slot - self.next_slot + 1
+        self.duplicated_frames += repeats - 1
+        self.next_slot = slot + 1
+        return repeats
+
+    def send_frame_with_retry(self, frame, retry_count=3, pts=None):
+        """Push the frame to FFmpeg with retry mechanism, retimed to the output frame rate when it has a pts."""
         if frame is None:
             logger.info(f"FFmpegStreamer Push Streaming failed, frame is none")
             return False
-        
+
+        repeats = self.get_frame_repeats(pts)
+        if not repeats:
+            return True
+
         for attempt in range(retry_count):
             try:
-                return self.send_frame(frame)
+                return all(self.send_frame(frame) for _ in range(repeats))
             except BrokenPipeError:
                 logger.error(f"FFmpegStreamer Push Streaming failed, retrying... (attempt {attempt + 1})")
                 time.sleep(1)
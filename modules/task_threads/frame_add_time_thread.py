@@ -66,30 +66,30 @@ class FrameAddTimeThread(threading.Thread):
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             frames = []
             while not self._stop_event.is_set():
-                if not self.queue.empty():
-                    try:
-                        # Fetch a frame from the queue
-                        frame = self.queue.get(timeout=1)
-                        # Submit the frame processing task to the executor
-                        frames.append(frame)
-                        
-                        # Ensure that futures are processed in the same order
-                        if len(frames) >= self.max_workers:
-                            results = list(executor.map(self.add_timestamp_to_image, frames))
-
-                            for future in results:
-                                if self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(future):
-                                    logger.error(f" Push stream failed...")
-                                    # self._stop_event.set()
-                                    break
-                            frames.clear()  # Clear the list of futures once processed
-
-                    except Exception as e:
-                        logger.error(f" An abnormal error occurred...{e}")
-                        continue
-                else:
-                    pass
-                    # logger.info(f"Queue is empty")
+                # Block until a frame arrives or the stage is stopped
+                frame_buffer = self.queue.get()
+                if frame_buffer is None:
+                    continue
+                try:
+                    # Submit the frame processing task to the executor
+                    frames.append(frame_buffer)
+
+                    # Ensure that futures are processed in the same order
+                    if len(frames) >= self.max_workers:
+                        results = list(executor.map(self.add_timestamp_to_image, [frame_buffer.frame for frame_buffer in frames]))
+
+                        for future in results:
+                            if self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(future):
+                                logger.error(f" Push stream failed...")
+                                # self._stop_event.set()
+                                break
+                        for frame_buffer in frames:
+                            frame_buffer.release()
+                        frames.clear()  # Clear the list of futures once processed
+
+                except Exception as e:
+                    logger.error(f" An abnormal error occurred...{e}")
+                    continue
 
     def process_single_frame(self, frame):
         # time.sleep(0.1)
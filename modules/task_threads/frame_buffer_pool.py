@@ -0,0 +1,118 @@
+
+from multiprocessing import shared_memory
+import queue
+import threading
+import numpy
+from modules.logger import logger
+
+
+class FrameBuffer:
+    """A preallocated frame that is owned by exactly one pipeline stage at a time.
+
+    The capture thread fills it, the processor hands it on, and whoever writes or
+    drops the frame last calls ``release()`` so the pool can reuse the memory.
+    """
+
+    def __init__(self, pool, index, frame):
+        self.pool = pool
+        self.index = index
+        self.frame = frame
+        # The frame as it lives in the pool's shared memory, worker processes can only see this one
+        self.shared_frame = frame if pool.shared_memory is not None else None
+        # time.monotonic() when the frame was read, the load shedder judges the frame age by it
+        self.capture_time = 0.0
+        # Presentation timestamp of the frame in seconds, the writer places the frame on the output timeline by it
+        self.pts = None
+        self._released = True
+
+    def release(self):
+        self.pool.release(self)
+
+    @property
+    def shared(self):
+        return self.shared_frame is not None and self.frame is self.shared_frame
+
+
+class FrameBufferPool:
+    """Ring of preallocated frames reused from capture through processing to the ffmpeg writer.
+
+    With ``shared=True`` the frames are views into one shared memory block, so
+    worker processes attach to it by ``shared_memory_name`` and read or write a
+    frame by its buffer index without pickling any pixels.
+    """
+
+    def __init__(self, width, height, count, stop_event=None, shared=False):
+        self.width = width
+        self.height = height
+        self.count = count
+        self.frame_shape = (height, width, 3)
+        self.frame_size = width * height * 3
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=self.frame_size * count) if shared else None
+        self._stop_event = stop_event
+        self._lock = threading.Lock()
+        self._free = queue.Queue()
+        for index in range(count):
+            self._free.put(FrameBuffer(self, index, self._create_frame(index)))
+
+        logger.info(
+            f"Initialized FrameBufferPool, "
+            f"Frame Size: {width}x{height}, "
+            f"Buffers: {count}, "
+            f"Shared: {shared}"
+        )
+
+    def _create_frame(self, index):
+        if self.shared_memory is None:
+            return numpy.empty(self.frame_shape, dtype=numpy.uint8)
+        return numpy.ndarray(self.frame_shape, dtype=numpy.uint8, buffer=self.shared_memory.buf, offset=index * self.frame_size)
+
+    @property
+    def shared_memory_name(self):
+        return self.shared_memory.name if self.shared_memory is not None else None
+
+    def acquire(self, timeout=None, poll_interval=0.5):
+        """Take a free buffer, blocking while every buffer is in flight. Returns None on timeout or stop."""
+        remaining = timeout
+        while self._stop_event is None or not self._stop_event.is_set():
+            wait = poll_interval if remaining is None else min(poll_interval, remaining)
+            try:
+                frame_buffer = self._free.get(timeout=wait)
+            except queue.Empty:
+                if remaining is not None:
+                    remaining -= wait
+                    if remaining <= 0:
+                        return None
+                continue
+            frame_buffer._released = False
+            return frame_buffer
+        return None
+
+    def release(self, frame_buffer):
+        with self._lock:
+            if frame_buffer._released:
+                logger.warning(f"FrameBuffer {frame_buffer.index} released twice")
+                return
+            frame_buffer._released = True
+        self._free.put(frame_buffer)
+
+    @property
+    def available(self):
+        return self._free.qsize()
+
+    def close(self):
+        """Free the shared memory block, the frames must not be used afterwards."""
+        if self.shared_memory is None:
+            return
+        # Drop our views first, the block cannot be closed while numpy still exports it
+        while True:
+            try:
+                frame_buffer = self._free.get_nowait()
+            except queue.Empty:
+                break
+            frame_buffer.frame = frame_buffer.shared_frame = None
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            logger.warning("FrameBufferPool shared memory is still referenced, leaving it mapped until exit")
+        self.shared_memory.unlink()
+        self.shared_memory = None
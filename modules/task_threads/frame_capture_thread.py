@@ -1,15 +1,22 @@
 import threading
+import cv2
 from modules.logger import logger
 import time
 
 class FrameCaptureThread(threading.Thread):
-    def __init__(self, cap, queue, stop_event, buffer_size=10, max_retries=20):
+    def __init__(self, cap, queue, stop_event, frame_buffer_pool, buffer_size=10, max_retries=20, drop_when_full=False):
         super().__init__()
         self.cap = cap
         self.queue = queue
+        self.frame_buffer_pool = frame_buffer_pool
         self._stop_event = stop_event
         self.buffer_size = buffer_size
         self.max_retries = max_retries
+        # Keep reading when the stage is full and drop its oldest frame, latency stays bounded
+        self.drop_when_full = drop_when_full
+        self.dropped_frames = 0
+        self._last_pts = None
+        self._last_capture_time = None
 
         self.name = self.__class__.__name__
 
@@ -18,34 +25,72 @@ class FrameCaptureThread(threading.Thread):
             f"Initialized {self.name},"
             f"Queue Size: {self.queue.qsize()}, "
             f"Buffer Size: {self.buffer_size}, "
-            f"Max Retries: {self.max_retries}"
+            f"Max Retries: {self.max_retries}, "
+            f"Drop When Full: {self.drop_when_full}"
         )
 
     def run(self):
         retry_count = 0
         while not self._stop_event.is_set() and retry_count < self.max_retries:
+            frame_buffer = None
             try:
-                if self.queue.qsize() < self.buffer_size:
-                    ret, frame = self.cap.read()
-                    if not ret:
-                        retry_count += 1
-                        logger.error(f"Failed to read frame, retrying... (attempt {retry_count})")
-                        time.sleep(0.01)  # Wait before retrying
-                    else:
-                        retry_count = 0  # Reset retry count on successful read
-                        self.queue.put(frame)
-                        # logger.info(f"Succeeded to read frame...{self.queue.qsize()}/{self.buffer_size}")
+                # Blocks while every buffer is in flight, returns None once the pipeline is stopped
+                frame_buffer = self.frame_buffer_pool.acquire()
+                if frame_buffer is None:
+                    continue
+                # Decode straight into the preallocated buffer
+                ret, frame = self.cap.read(frame_buffer.frame)
+                if not ret:
+                    frame_buffer.release()
+                    retry_count += 1
+                    logger.error(f"Failed to read frame, retrying... (attempt {retry_count})")
+                    time.sleep(0.01)  # Wait before retrying
                 else:
-                    time.sleep(0.01)  # Avoid busy-waiting when the buffer is full
+                    retry_count = 0  # Reset retry count on successful read
+                    frame_buffer.capture_time = time.monotonic()
+                    frame_buffer.pts = self.read_pts(frame_buffer.capture_time)
+                    if frame is not frame_buffer.frame:
+                        # The stream changed its frame size, adopt the new frame for this buffer
+                        frame_buffer.frame = frame
+                    if self.drop_when_full:
+                        self._put_dropping_oldest(frame_buffer)
+                    # Blocks while the stage is full, returns False once the pipeline is stopped
+                    elif not self.queue.put(frame_buffer):
+                        frame_buffer.release()
+                    # logger.info(f"Succeeded to read frame...{self.queue.qsize()}/{self.buffer_size}")
 
             except Exception as e:
                 logger.error(f"Error in FrameCaptureThread: {e}")
+                if frame_buffer is not None:
+                    frame_buffer.release()
                 retry_count += 1
                 time.sleep(1)  # Wait before retrying
 
         if retry_count >= self.max_retries:
             logger.error("Maximum retries reached for reading frames. Stopping thread.")
 
+    def _put_dropping_oldest(self, frame_buffer):
+        while not self.queue.put_nowait(frame_buffer):
+            if self.queue.stopped:
+                frame_buffer.release()
+                return
+            stale_frame_buffer = self.queue.get_nowait()
+            if stale_frame_buffer is not None:
+                stale_frame_buffer.release()
+                self.dropped_frames += 1
+                if self.dropped_frames % 100 == 1:
+                    logger.warning(f"FrameCaptureThread dropped {self.dropped_frames} stale frames, the pipeline is falling behind")
+
+    def read_pts(self, capture_time):
+        """Timestamp of the frame just read, from the capture when it reports one, otherwise from the wall clock."""
+        pts = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if self._last_pts is not None and pts <= self._last_pts:
+            # The backend reports no usable position, follow the arrival time instead
+            pts = self._last_pts + (capture_time - self._last_capture_time)
+        self._last_pts = pts
+        self._last_capture_time = capture_time
+        return pts
+
     def stop(self):
         logger.info(
             f"Stop FrameCaptureThread: "
@@ -0,0 +1,169 @@
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import numpy
+from modules.logger import logger
+
+
+def suggest_frame_process_workers():
+    # each worker runs its own inference sessions, a group of four cores per worker keeps them from oversubscribing
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+def frame_process_worker(settings, frame_processor_names, face_source_path, shared_memory_name, frame_shape, frame_count, task_queue, result_queue):
+    """Worker process main: load the processors once, then process frame windows in the shared memory block."""
+    from modules.face_live import restore_globals
+    from modules.processors.frame.core import clear_reuse_state, get_frame_processors_modules
+    from modules.source_face_cache import get_source_face
+    from modules.task_threads.frame_processor_thread import process_frame_window
+
+    restore_globals(settings)
+    frame_processors = get_frame_processors_modules(frame_processor_names)
+    clear_reuse_state(frame_processors)
+    source_face = get_source_face(face_source_path)
+    frame_memory = shared_memory.SharedMemory(name=shared_memory_name)
+    frame_size = int(numpy.prod(frame_shape))
+    frames = [numpy.ndarray(frame_shape, dtype=numpy.uint8, buffer=frame_memory.buf, offset=index * frame_size) for index in range(frame_count)]
+    result_queue.put(('ready', os.getpid(), None, 0.0))
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            task_id, frame_indices, frame_faces, actions, sequences = task
+            start_time = time.perf_counter()
+            try:
+                processed_frames = process_frame_window(frame_processors, source_face, [frames[index] for index in frame_indices], frame_faces, actions, sequences)
+                # Results go back into the same slots, the parent writes them from there
+                for index, processed_frame in zip(frame_indices, processed_frames):
+                    if processed_frame is not frames[index]:
+                        numpy.copyto(frames[index], processed_frame)
+                result_queue.put((task_id, os.getpid(), None, time.perf_counter() - start_time))
+            except Exception as e:
+                result_queue.put((task_id, os.getpid(), repr(e), time.perf_counter() - start_time))
+    finally:
+        frames.clear()
+        frame_memory.close()
+
+
+class FrameProcessPool:
+    """Run the frame processors of a stream in worker processes instead of threads.
+
+    Every worker loads its own models and attaches to the shared memory block of
+    a shared FrameBufferPool. Tasks only carry buffer indices, tracked faces and
+    load shedder actions, the pixels stay in shared memory and the processed
+    frames are written back into the same buffers. ``submit`` returns a Future
+    of the processed frames, like the thread pool it replaces. If a worker dies
+    the pool fails the pending windows and sets the stop event so the stream
+    restarts.
+    """
+
+    def __init__(self, frame_processor_names, face_source_path, frame_buffer_pool, stop_event, workers=0, settings=None, start_timeout=300):
+        self.frame_buffer_pool = frame_buffer_pool
+        self.workers = workers or suggest_frame_process_workers()
+        self._stop_event = stop_event
+        self._context = multiprocessing.get_context('spawn')
+        self._task_queue = self._context.Queue()
+        self._result_queue = self._context.Queue()
+        self._futures = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._broken = False
+        self._processes = [
+            self._context.Process(
+                target=frame_process_worker,
+                args=(settings, frame_processor_names, face_source_path, frame_buffer_pool.shared_memory_name, frame_buffer_pool.frame_shape, frame_buffer_pool.count, self._task_queue, self._result_queue),
+                name=f'FrameProcessWorker-{index}',
+                daemon=True
+            )
+            for index in range(self.workers)
+        ]
+        for process in self._processes:
+            process.start()
+        self._wait_until_ready(start_timeout)
+        self._result_thread = threading.Thread(target=self._collect_results, name='FrameProcessPoolResults', daemon=True)
+        self._result_thread.start()
+
+        logger.info(
+            f"Initialized FrameProcessPool, "
+            f"Workers: {self.workers}, "
+            f"Frame Processors: {frame_processor_names}"
+        )
+
+    def _wait_until_ready(self, timeout):
+        ready = 0
+        deadline = time.monotonic() + timeout
+        while ready < self.workers:
+            if not all(process.is_alive() for process in self._processes):
+                self.shutdown()
+                raise RuntimeError("A frame process worker exited while loading the frame processors")
+            try:
+                self._result_queue.get(timeout=1)
+                ready += 1
+            except queue.Empty:
+                if time.monotonic() > deadline:
+                    self.shutdown()
+                    raise RuntimeError(f"Frame process workers were not ready within {timeout} seconds")
+
+    def submit(self, frame_buffers, frame_faces=None, actions=None, sequences=None):
+        """Process the frame buffers in a worker, the Future resolves to their processed frames."""
+        future = Future()
+        if self._broken:
+            future.set_exception(RuntimeError("FrameProcessPool is broken"))
+            return future
+        if not all(frame_buffer.shared for frame_buffer in frame_buffers):
+            future.set_exception(RuntimeError("Frame is not in the shared frame buffer pool, the stream changed its frame size"))
+            return future
+
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._futures[task_id] = (future, frame_buffers)
+        self._task_queue.put((task_id, [frame_buffer.index for frame_buffer in frame_buffers], frame_faces, actions, sequences))
+        return future
+
+    def _collect_results(self):
+        while not self._broken:
+            try:
+                task_id, pid, error, processing_time = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self._processes):
+                    self._fail_pending("A frame process worker exited unexpectedly")
+                continue
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future, frame_buffers = self._futures.pop(task_id, (None, None))
+            if future is None:
+                continue
+            if error:
+                future.set_exception(RuntimeError(f"Frame process worker {pid} failed: {error}"))
+            else:
+                future.processing_time = processing_time
+                future.set_result([frame_buffer.frame for frame_buffer in frame_buffers])
+
+    def _fail_pending(self, reason):
+        logger.error(f"FrameProcessPool: {reason}, stopping the stream")
+        self._broken = True
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures.clear()
+        for future, _ in futures:
+            future.set_exception(RuntimeError(reason))
+        self._stop_event.set()
+
+    def shutdown(self, timeout=3):
+        self._broken = True
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=timeout)
+            if process.is_alive():
+                logger.warning(f"Terminating {process.name}")
+                process.terminate()
+        logger.info("FrameProcessPool shut down")
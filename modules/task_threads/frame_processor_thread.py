@@ -3,6 +3,7 @@ import threading
 from modules.logger import logger
 import time
 import concurrent.futures
+import functools
 import queue
 
 
@@ -10,9 +11,53 @@ import cv2
 import time
 import datetime
 
+from modules.face_analyser import face_analyser_scope, inherit_scope_faces, set_scope_faces
+from modules.processors.frame.core import clear_reuse_state, process_frame_batch, reuse_frame
+from modules.task_threads.frame_reorder_buffer import FrameReorderBuffer
+from modules.task_threads.load_shedder import DROP, PROCESS, REUSE
+
+
+def count_processed_frames(frames, actions=None):
+    if actions is None:
+        return len(frames)
+    return sum(action == PROCESS for action in actions)
+
+
+def process_frame_window(frame_processors, source_face, frames, frame_faces=None, actions=None, sequences=None):
+    """Run the frame processors over a window of frames in order.
+
+    ``frame_faces`` hands tracked faces to every processor instead of running the
+    detector again. ``actions`` comes from the load shedder, frames marked reuse
+    only get the processors' cheap reuse path and passthrough frames are left as
+    they are. Reuse needs tracked faces, without them a reuse frame passes
+    through. ``sequences`` are the stream sequence numbers of the frames, the
+    processors only reuse results of earlier frames. Shared by the processor
+    thread and the frame process pool workers.
+    """
+    frames = list(frames)
+    actions = actions or [PROCESS] * len(frames)
+    process_indices = [index for index, action in enumerate(actions) if action == PROCESS]
+    reuse_indices = [index for index, action in enumerate(actions) if action == REUSE and frame_faces is not None]
+
+    with face_analyser_scope():
+        for frame_processor in frame_processors:
+            if frame_faces is not None:
+                for index in process_indices + reuse_indices:
+                    set_scope_faces(frames[index], frame_faces[index])
+            if process_indices:
+                processed_frames = process_frame_batch(frame_processor, source_face, [frames[index] for index in process_indices], [sequences[index] for index in process_indices] if sequences else None)
+                for index, processed_frame in zip(process_indices, processed_frames):
+                    inherit_scope_faces(frames[index], processed_frame)
+                    frames[index] = processed_frame
+            for index in reuse_indices:
+                reused_frame = reuse_frame(frame_processor, source_face, frames[index], sequences[index] if sequences else None)
+                inherit_scope_faces(frames[index], reused_frame)
+                frames[index] = reused_frame
+    return frames
+
 
 class FrameProcessorThread(threading.Thread):
-    def __init__(self, queue, frame_processors, source_image, ffmpeg_processor, stop_event, max_workers=10):
+    def __init__(self, queue, frame_processors, source_image, ffmpeg_processor, stop_event, max_workers=10, max_in_flight=None, batch_size=1, face_tracker=None, load_shedder=None, process_pool=None):
         super().__init__()
         self.queue = queue
         self.frame_processors = frame_processors
@@ -20,14 +65,29 @@ class FrameProcessorThread(threading.Thread):
         self.ffmpeg_processor = ffmpeg_processor
         self._stop_event = stop_event
         self.max_workers = max_workers
-        
+        self.max_in_flight = max_in_flight or max_workers * 2
+        self.batch_size = max(1, batch_size)
+        self.face_tracker = face_tracker
+        self.load_shedder = load_shedder
+        # Run the processors in worker processes, the frames must come from a shared frame buffer pool
+        self.process_pool = process_pool
+        self.reorder_buffer = FrameReorderBuffer(self._push_frame, max_in_flight=self.max_in_flight)
+        # Sequences start again at 0, results kept by an earlier run of the stream must not be reused
+        if not self.process_pool:
+            clear_reuse_state(self.frame_processors)
+
         self.name = self.__class__.__name__
 
         # Log the properties when initializing the thread
         logger.info(
             f"Initialized {self.name},"
             f"Queue Size: {self.queue.qsize()}, "
-            f"Max Workers: {self.max_workers}"
+            f"Max Workers: {self.max_workers}, "
+            f"Max In Flight: {self.max_in_flight}, "
+            f"Batch Size: {self.batch_size}, "
+            f"Face Tracking: {self.face_tracker is not None}, "
+            f"Load Shedding: {self.load_shedder is not None}, "
+            f"Process Pool: {self.process_pool is not None}"
         )
 
     # def run(self):
@@ -64,34 +124,106 @@ class FrameProcessorThread(threading.Thread):
 
     def run(self):
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            frames = []
             while not self._stop_event.is_set():
-                if not self.queue.empty():
-                    try:
-                        # Fetch a frame from the queue
-                        frame = self.queue.get(timeout=1)
-                        # Submit the frame processing task to the executor
-                        frames.append(frame)
-                        
-                        # Ensure that futures are processed in the same order
-                        if len(frames) >= self.max_workers:
-                            # results = frames
-                            results = list(executor.map(self.process_single_frame, frames))
-                            # results = list(executor.map(self.add_timestamp_to_image, frames))
-
-                            for future in results:
-                                if self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(future):
-                                    logger.error(f" Push stream failed...")
-                                    # self._stop_event.set()
-                                    break
-                            frames.clear()  # Clear the list of futures once processed
-
-                    except Exception as e:
-                        logger.error(f" An abnormal error occurred...{e}")
-                        continue
-                else:
-                    pass
-                    # logger.info(f"Queue is empty")
+                # Block until a frame arrives or the stage is stopped
+                frame_buffer = self.queue.get()
+                if frame_buffer is None:
+                    continue
+
+                sequences = None
+                future = None
+                try:
+                    # Frames that are already waiting join the window, we never wait to fill it
+                    frame_buffers = [frame_buffer] + self._collect_ready_frames()
+                    actions = None
+                    if self.load_shedder:
+                        frame_buffers, actions = self._shed_frames(frame_buffers)
+                        if not frame_buffers:
+                            continue
+                    frames = [frame_buffer.frame for frame_buffer in frame_buffers]
+
+                    # Wait for free slots in the in-flight window, frames are written in capture order
+                    sequences = self._reserve_sequences(len(frames))
+                    if sequences is None:
+                        for frame_buffer in frame_buffers:
+                            frame_buffer.release()
+                        break
+
+                    # The tracker keeps per-stream state, so it runs here in capture order
+                    frame_faces = [self.face_tracker.track(frame) for frame in frames] if self.face_tracker else None
+
+                    # Submit the window as soon as it arrives instead of waiting for a full batch
+                    if self.process_pool:
+                        future = self.process_pool.submit(frame_buffers, frame_faces, actions, sequences)
+                        if self.load_shedder:
+                            future.add_done_callback(functools.partial(self._record_processing_time, actions))
+                    else:
+                        future = executor.submit(self.process_frame_window, frames, frame_faces, actions, sequences)
+                    future.add_done_callback(functools.partial(self._on_frames_processed, sequences, frame_buffers))
+
+                except Exception as e:
+                    logger.error(f" An abnormal error occurred...{e}")
+                    if sequences and future is None:
+                        # Fill the reserved slots so the window drains and the buffers go back to the pool
+                        for sequence, frame_buffer in zip(sequences, frame_buffers):
+                            self.reorder_buffer.complete(sequence, (frame_buffer, None))
+                    continue
+
+    def _collect_ready_frames(self):
+        frames = []
+        while len(frames) < self.batch_size - 1:
+            frame = self.queue.get_nowait()
+            if frame is None:
+                break
+            frames.append(frame)
+        return frames
+
+    def _shed_frames(self, frame_buffers):
+        """Ask the load shedder what to do with each frame, dropped frames go straight back to the pool."""
+        now = time.monotonic()
+        queue_depth = self.queue.qsize()
+        kept_frame_buffers = []
+        actions = []
+        for frame_buffer in frame_buffers:
+            action = self.load_shedder.decide(now - frame_buffer.capture_time, queue_depth)
+            if action == DROP:
+                frame_buffer.release()
+                continue
+            kept_frame_buffers.append(frame_buffer)
+            actions.append(action)
+        return kept_frame_buffers, actions
+
+    def _reserve_sequences(self, count):
+        sequences = []
+        while len(sequences) < count:
+            if self._stop_event.is_set():
+                return None
+            sequence = self.reorder_buffer.reserve(timeout=1)
+            if sequence is not None:
+                sequences.append(sequence)
+        return sequences
+
+    def _record_processing_time(self, actions, future):
+        if not future.exception():
+            self.load_shedder.record(future.processing_time, count_processed_frames(future.result(), actions))
+
+    def _on_frames_processed(self, sequences, frame_buffers, future):
+        try:
+            processed_frames = future.result()
+        except Exception as e:
+            logger.error(f" Failed to process frames {sequences[0]}-{sequences[-1]}...{e}")
+            processed_frames = [None] * len(sequences)
+        for sequence, frame_buffer, processed_frame in zip(sequences, frame_buffers, processed_frames):
+            self.reorder_buffer.complete(sequence, (frame_buffer, processed_frame))
+
+    def _push_frame(self, item):
+        frame_buffer, frame = item
+        try:
+            if frame is not None and self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(frame, pts=frame_buffer.pts):
+                logger.error(f" Push stream failed...")
+        finally:
+            # The frame has been written or dropped, the capture buffer can be reused
+            frame_buffer.release()
 
     def process_single_frame(self, frame):
         # time.sleep(0.1)
@@ -107,6 +239,13 @@ class FrameProcessorThread(threading.Thread):
         # logger.info(f"Program runtime: {int(hours)} hours {int(minutes)} minutes {seconds:.2f} seconds")
         return frame
 
+    def process_frame_window(self, frames, frame_faces=None, actions=None, sequences=None):
+        start_time = time.perf_counter()
+        frames = process_frame_window(self.frame_processors, self.source_image, frames, frame_faces, actions, sequences)
+        if self.load_shedder:
+            self.load_shedder.record(time.perf_counter() - start_time, count_processed_frames(frames, actions))
+        return frames
+
     def add_timestamp_to_image(self, image):
         # 检查图像是否成功加载
         if image is None:
@@ -20,27 +20,28 @@ class FramePullThread(threading.Thread):
     def run(self):
             futures = []
             while not self._stop_event.is_set():
-                if not self.queue.empty():
-                    try:
-                        # Fetch a frame from the queue
-                        frame = self.queue.get(timeout=1)
-                        # Submit the frame processing task to the executor
-                        futures.append(frame)
-                        
-                        # Ensure that futures are processed in the same order
-                        if len(futures) >= self.max_workers:
-                            for future in futures:
-                                if self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(future):
-                                    logger.error(f" Push stream failed...")
-                                    # self._stop_event.set()
-                                    break
-                            futures.clear()  # Clear the list of futures once processed
+                # Block until a frame arrives or the stage is stopped
+                frame_buffer = self.queue.get()
+                if frame_buffer is None:
+                    continue
+                try:
+                    # Submit the frame processing task to the executor
+                    futures.append(frame_buffer)
 
-                    except Exception as e:
-                        logger.error(f" An abnormal error occurred...{e}")
-                        continue
-                else:
-                    logger.info(f"Queue is empty")
+                    # Ensure that futures are processed in the same order
+                    if len(futures) >= self.max_workers:
+                        for future in futures:
+                            if self.ffmpeg_processor and not self.ffmpeg_processor.send_frame_with_retry(future.frame):
+                                logger.error(f" Push stream failed...")
+                                # self._stop_event.set()
+                                break
+                        for future in futures:
+                            future.release()
+                        futures.clear()  # Clear the list of futures once processed
+
+                except Exception as e:
+                    logger.error(f" An abnormal error occurred...{e}")
+                    continue
 
     def stop(self):
         logger.info(
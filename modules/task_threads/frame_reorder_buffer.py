@@ -0,0 +1,45 @@
+
+import threading
+from modules.logger import logger
+
+
+class FrameReorderBuffer:
+    """Collect out-of-order results and hand them to the sink in sequence order."""
+
+    def __init__(self, sink, max_in_flight=24):
+        self.sink = sink
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._results = {}
+        self._next_sequence = 0
+        self._reserved_sequence = 0
+
+    def reserve(self, timeout=None):
+        """Reserve the next sequence number, blocking while the in-flight window is full."""
+        if not self._slots.acquire(timeout=timeout):
+            return None
+        with self._lock:
+            sequence = self._reserved_sequence
+            self._reserved_sequence += 1
+        return sequence
+
+    def complete(self, sequence, frame):
+        """Store the result for a sequence and flush every frame that is now in order."""
+        with self._lock:
+            self._results[sequence] = frame
+            while self._next_sequence in self._results:
+                ready_frame = self._results.pop(self._next_sequence)
+                self._next_sequence += 1
+                self._slots.release()
+                if ready_frame is None:
+                    continue
+                try:
+                    self.sink(ready_frame)
+                except Exception as e:
+                    logger.error(f"FrameReorderBuffer sink failed: {e}")
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._reserved_sequence - self._next_sequence
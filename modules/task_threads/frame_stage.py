@@ -0,0 +1,109 @@
+
+import queue
+import time
+
+
+class FrameStage:
+    """Bounded blocking hand-off between two pipeline threads.
+
+    Producers and consumers block on the underlying queue instead of polling it.
+    Waits are sliced by ``poll_interval`` so a set stop event is noticed without
+    spinning, and ``close()`` wakes blocked consumers immediately with a sentinel.
+    """
+
+    _SENTINEL = object()
+
+    def __init__(self, stop_event, maxsize=0, poll_interval=0.5):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop_event = stop_event
+        self._closed = False
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+
+    @property
+    def stopped(self):
+        return self._closed or self._stop_event.is_set()
+
+    def put(self, item, timeout=None):
+        """Block until the item is queued. Returns False on timeout or when the stage stops."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.stopped:
+            wait = self._wait_slice(deadline)
+            if wait is None:
+                return False
+            try:
+                self._queue.put(item, timeout=wait)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, timeout=None):
+        """Block until an item is available. Returns None on timeout or when the stage stops."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.stopped:
+            wait = self._wait_slice(deadline)
+            if wait is None:
+                return None
+            try:
+                item = self._queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if item is self._SENTINEL:
+                # Pass the sentinel on so every other consumer wakes up too
+                self._put_sentinel()
+                return None
+            return item
+        return None
+
+    def put_nowait(self, item):
+        """Queue the item if there is room. Returns False when the stage is full or stopped."""
+        if self.stopped:
+            return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def get_nowait(self):
+        """Return an already queued item, or None when the stage is empty or stopped."""
+        if self.stopped:
+            return None
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            return None
+        if item is self._SENTINEL:
+            self._put_sentinel()
+            return None
+        return item
+
+    def close(self):
+        """Stop the stage and wake up every blocked consumer."""
+        self._closed = True
+        self._put_sentinel()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def full(self):
+        return self._queue.full()
+
+    def _put_sentinel(self):
+        try:
+            self._queue.put_nowait(self._SENTINEL)
+        except queue.Full:
+            # Consumers still notice the closed flag on their next wait slice
+            pass
+
+    def _wait_slice(self, deadline):
+        if deadline is None:
+            return self.poll_interval
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        return min(self.poll_interval, remaining)
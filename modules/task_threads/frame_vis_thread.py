@@ -18,11 +18,11 @@ class FrameVisThread(threading.Thread):
 
     def run(self):
         while not self._stop_event.is_set():
-            if self.queue.empty() !=True:
-                frame=self.queue.get()
-                cv2.imshow("frame1", frame)
-            else:
-                 logger.info(f"Queue is empty")
+            # Wait about one display refresh for a frame so the window keeps pumping events
+            frame_buffer = self.queue.get(timeout=0.03)
+            if frame_buffer is not None:
+                cv2.imshow("frame1", frame_buffer.frame)
+                frame_buffer.release()
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
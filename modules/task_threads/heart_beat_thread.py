@@ -17,8 +17,7 @@ class HeartbeatThread(threading.Thread):
         )
 
     def run(self):
-        while not self._stop_event.is_set():
-            time.sleep(self.interval)
+        while not self._stop_event.wait(self.interval):
             logger.info("Heartbeat: Program is running normally")
 
     def stop(self):
@@ -0,0 +1,95 @@
+import threading
+import time
+from modules.logger import logger
+
+PROCESS = 'process'
+REUSE = 'reuse'
+PASSTHROUGH = 'passthrough'
+DROP = 'drop'
+ACTIONS = [PROCESS, REUSE, PASSTHROUGH, DROP]
+
+
+class LoadShedder:
+    """Decide per frame how much work the live pipeline can afford.
+
+    The predicted latency of a frame is its age since capture plus the moving
+    average processing time. Below ``target_latency`` the frame is processed.
+    Above it the frame reuses the last swap result on the tracked landmarks,
+    or passes through unprocessed when ``allow_reuse`` is off, and at most
+    ``max_reuse_frames`` frames in a row are degraded so the reused result stays
+    fresh. Above ``max_latency`` the frame is dropped, the writer fills its
+    slot by repeating the next frame. Queue depth escalates the same way, so
+    a backlog is cut before the frames in it have aged.
+    """
+
+    def __init__(self, target_latency=0.5, max_latency=2.0, queue_size=100, degrade_queue_ratio=0.5, drop_queue_ratio=0.9, allow_reuse=True, max_reuse_frames=4, smoothing=0.1, log_interval=60):
+        self.target_latency = target_latency
+        self.max_latency = max(max_latency, target_latency)
+        self.degrade_queue_depth = max(1, int(queue_size * degrade_queue_ratio)) if queue_size else None
+        self.drop_queue_depth = max(1, int(queue_size * drop_queue_ratio)) if queue_size else None
+        self.allow_reuse = allow_reuse
+        self.max_reuse_frames = max_reuse_frames
+        self.smoothing = smoothing
+        self.log_interval = log_interval
+        self.processing_time = 0.0
+        self.counts = { action: 0 for action in ACTIONS }
+        self._degraded_frames = 0
+        self._lock = threading.Lock()
+        self._last_log_time = time.monotonic()
+
+        logger.info(
+            f"Initialized LoadShedder, "
+            f"Target Latency: {self.target_latency}, "
+            f"Max Latency: {self.max_latency}, "
+            f"Degrade Queue Depth: {self.degrade_queue_depth}, "
+            f"Drop Queue Depth: {self.drop_queue_depth}, "
+            f"Allow Reuse: {self.allow_reuse}"
+        )
+
+    def decide(self, frame_age, queue_depth=0):
+        with self._lock:
+            predicted_latency = frame_age + self.processing_time
+            if predicted_latency > self.max_latency or (self.drop_queue_depth and queue_depth >= self.drop_queue_depth):
+                action = DROP
+            elif predicted_latency > self.target_latency or (self.degrade_queue_depth and queue_depth >= self.degrade_queue_depth):
+                if self._degraded_frames >= self.max_reuse_frames:
+                    action = PROCESS
+                else:
+                    action = REUSE if self.allow_reuse else PASSTHROUGH
+            else:
+                action = PROCESS
+
+            if action == PROCESS:
+                self._degraded_frames = 0
+            elif action != DROP:
+                self._degraded_frames += 1
+            self.counts[action] += 1
+
+            now = time.monotonic()
+            log_stats = now - self._last_log_time > self.log_interval
+            if log_stats:
+                self._last_log_time = now
+        if log_stats:
+            self.log_stats()
+        return action
+
+    def record(self, processing_time, frame_count=1):
+        """Feed the wall time spent processing ``frame_count`` frames into the moving average."""
+        if frame_count <= 0:
+            return
+        with self._lock:
+            frame_time = processing_time / frame_count
+            if not self.processing_time:
+                self.processing_time = frame_time
+            else:
+                self.processing_time += self.smoothing * (frame_time - self.processing_time)
+
+    def log_stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+            processing_time = self.processing_time
+        logger.info(
+            f"LoadShedder: "
+            f"Processing Time: {processing_time * 1000:.1f} ms, "
+            + ", ".join(f"{action.capitalize()}: {count}" for action, count in counts.items())
+        )
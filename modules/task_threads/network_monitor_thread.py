@@ -20,7 +20,7 @@ class NetworkMonitorThread(threading.Thread):
             self.network_available = self.is_network_available()
             if not self.network_available:
                 logger.warning("网络不可用，等待恢复...")
-            time.sleep(self.interval)
+            self._stop_event.wait(self.interval)
 
     def is_network_available(self):
         """检查网络是否可用"""
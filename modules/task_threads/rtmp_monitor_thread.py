@@ -21,9 +21,7 @@ class RTMPMonitorThread(threading.Thread):
         )
 
     def run(self):
-        while not self._stop_event.is_set():
-            time.sleep(self.interval)
-
+        while not self._stop_event.wait(self.interval):
             self.network_available = self.is_rtmp_available(self.rtmp_url)
             if not self.network_available:
                 logger.warning(f"RTMP server is unavailable: {self.rtmp_url}")
@@ -17,8 +17,7 @@ class RuntimeMonitorThread(threading.Thread):
         )
 
     def run(self):
-        while not self._stop_event.is_set():
-            time.sleep(self.interval)
+        while not self._stop_event.wait(self.interval):
             self.measure_runtime(self.start_time)
 
     def measure_runtime(self, start_time):
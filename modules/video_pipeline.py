@@ -0,0 +1,376 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import collections
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import numpy
+from tqdm import tqdm
+
+import modules.globals
+from modules.capturer import get_video_frame_total
+from modules.logger import logger
+from modules.processors.frame.core import get_chain_source_face, get_frame_processors_modules, needs_source_face
+from modules.source_face_cache import get_source_hash
+from modules.task_threads.frame_processor_thread import process_frame_window
+from modules.typing import Frame
+from modules.utilities import detect_fps, get_temp_directory_path
+
+VIDEO_JOB_DIRECTORY = 'job'
+VIDEO_JOB_MANIFEST = 'manifest.json'
+
+
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    """Size of the frames ffmpeg decodes from the video, after the rotation it applies."""
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation', '-of', 'json', target_path]
+    stream = json.loads(subprocess.check_output(command))['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    rotation = stream.get('tags', {}).get('rotate') or next((side_data['rotation'] for side_data in stream.get('side_data_list', []) if 'rotation' in side_data), 0)
+    if abs(int(rotation)) % 180 == 90:
+        return height, width
+    return width, height
+
+
+class FFmpegPipe:
+    """ffmpeg subprocess whose stderr is drained in the background, the tail is kept for the error message."""
+
+    def __init__(self, args: List[str], **kwargs: Any) -> None:
+        commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level]
+        commands.extend(args)
+        self.process = subprocess.Popen(commands, stderr=subprocess.PIPE, **kwargs)
+        self.stderr_tail: Deque[str] = collections.deque(maxlen=20)
+        self._stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_thread.start()
+
+    def _read_stderr(self) -> None:
+        for line in iter(self.process.stderr.readline, b''):
+            self.stderr_tail.append(line.decode(errors='replace').rstrip())
+
+    def wait(self) -> bool:
+        self.process.wait()
+        self._stderr_thread.join(timeout=1)
+        if self.process.returncode != 0:
+            logger.error(f"ffmpeg exited with {self.process.returncode}: {' | '.join(self.stderr_tail)}")
+        return self.process.returncode == 0
+
+
+def read_frame(stream: Any, width: int, height: int) -> Optional[Frame]:
+    frame = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    view = memoryview(frame).cast('B')
+    size = 0
+    while size < len(view):
+        count = stream.readinto(view[size:])
+        if not count:
+            return None
+        size += count
+    return frame
+
+
+def write_frame(stream: Any, frame: Frame) -> None:
+    stream.write(memoryview(numpy.ascontiguousarray(frame)).cast('B'))
+
+
+def process_window(frame_processors: List[Any], source_face: Any, frames: List[Frame]) -> List[Frame]:
+    try:
+        return process_frame_window(frame_processors, source_face, frames)
+    except Exception as exception:
+        # like the frame path, a frame that fails is kept as it is
+        logger.exception(f"Video pipeline failed to process {len(frames)} frames: {exception}")
+        return frames
+
+
+def get_encode_args(width: int, height: int, fps: float) -> List[str]:
+    return ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+
+
+def get_video_codec_args() -> List[str]:
+    # same encode as create_video, the output matches the frames path
+    return ['-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1']
+
+
+def get_audio_args(target_path: str) -> List[str]:
+    if modules.globals.keep_audio:
+        return ['-i', target_path, '-map', '0:v:0', '-map', '1:a:0?']
+    return []
+
+
+def probe_keyframe_segments(target_path: str, segment_duration: float) -> List[Dict[str, Any]]:
+    """Split the video stream into segments that start on a keyframe and last at least ``segment_duration`` seconds.
+
+    Only the packets are read, nothing is decoded. Every segment gets the
+    time of its first keyframe and the number of frames up to the next one.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', target_path]
+    packets = []
+    for line in subprocess.check_output(command).decode().splitlines():
+        pts_time, _, flags = line.partition(',')
+        try:
+            packets.append((float(pts_time), 'K' in flags))
+        except ValueError:
+            continue
+    packets.sort()
+    segments: List[Dict[str, Any]] = []
+    for pts_time, keyframe in packets:
+        if not segments or (keyframe and pts_time - segments[-1]['start_time'] >= segment_duration):
+            segments.append({ 'index': len(segments), 'start_time': pts_time, 'frame_count': 0 })
+        segments[-1]['frame_count'] += 1
+    return segments
+
+
+class VideoJob:
+    """Manifest of a resumable in-memory video job.
+
+    The target is planned as keyframe aligned segments, each is processed and
+    encoded on its own. A segment is renamed into place and marked done in the
+    manifest only once its encoder has exited cleanly, so after a crash the
+    job resumes with the segments that are not done. The manifest is keyed by
+    the source face, the target file, the processors and the encode settings;
+    a run with different ones starts over.
+    """
+
+    def __init__(self, job_directory: str, job_key: str, target_path: str) -> None:
+        self.job_directory = job_directory
+        self.target_path = target_path
+        self.manifest_path = os.path.join(job_directory, VIDEO_JOB_MANIFEST)
+        self.manifest: Dict[str, Any] = { 'key': job_key, 'segments': [] }
+        self._lock = threading.Lock()
+        manifest = self.read_manifest()
+        if manifest and manifest.get('key') == job_key:
+            self.manifest = manifest
+        elif os.path.isdir(job_directory):
+            shutil.rmtree(job_directory)
+        os.makedirs(job_directory, exist_ok=True)
+
+    def read_manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self) -> None:
+        temp_manifest_path = self.manifest_path + '.tmp'
+        with open(temp_manifest_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(temp_manifest_path, self.manifest_path)
+
+    @property
+    def segments(self) -> List[Dict[str, Any]]:
+        return self.manifest['segments']
+
+    def plan(self, segments: List[Dict[str, Any]]) -> None:
+        for segment in segments:
+            segment['path'] = f"{segment['index']:05d}.mkv"
+            segment['done'] = False
+        self.manifest['segments'] = segments
+        self.write_manifest()
+
+    def get_pending_segments(self) -> List[Dict[str, Any]]:
+        return [segment for segment in self.segments if not segment['done']]
+
+    def get_done_frames(self) -> int:
+        return sum(segment['frame_count'] for segment in self.segments if segment['done'])
+
+    def get_segment_path(self, segment: Dict[str, Any]) -> str:
+        return os.path.join(self.job_directory, segment['path'])
+
+    def set_segment_done(self, segment: Dict[str, Any]) -> None:
+        with self._lock:
+            segment['done'] = True
+            self.write_manifest()
+
+    def concat(self, output_path: str) -> bool:
+        """Join the segments without re-encoding them, the target's audio is mapped in the same pass."""
+        concat_list_path = os.path.join(self.job_directory, 'segments.txt')
+        with open(concat_list_path, 'w') as concat_list_file:
+            for segment in self.segments:
+                segment_path = self.get_segment_path(segment).replace("'", "'\\''")
+                concat_list_file.write(f"file '{segment_path}'\n")
+        concat = FFmpegPipe(['-f', 'concat', '-safe', '0', '-i', concat_list_path] + get_audio_args(self.target_path) + ['-c:v', 'copy', '-y', output_path], stdin=subprocess.DEVNULL)
+        return concat.wait()
+
+    def remove(self) -> None:
+        shutil.rmtree(self.job_directory, ignore_errors=True)
+
+
+def get_video_job_key(frame_processors: List[Any], source_path: Optional[str], target_path: str, width: int, height: int, fps: float, segment_duration: float) -> str:
+    target_stat = os.stat(target_path)
+    job_settings = {
+        'source': get_source_hash(source_path) if source_path and needs_source_face(frame_processors) else None,
+        'target': [os.path.abspath(target_path), target_stat.st_size, target_stat.st_mtime],
+        'frame_processors': list(modules.globals.frame_processors),
+        'many_faces': modules.globals.many_faces,
+        'video_encoder': modules.globals.video_encoder,
+        'video_quality': modules.globals.video_quality,
+        'resolution': [width, height],
+        'fps': fps,
+        'segment_duration': segment_duration
+    }
+    return hashlib.sha1(json.dumps(job_settings, sort_keys=True).encode()).hexdigest()
+
+
+def run_video_pipeline(decoder: FFmpegPipe, executor: Executor, max_in_flight: int, frame_processors: List[Any], source_face: Any, width: int, height: int, write_frames: Callable[[List[Frame]], None], progress: Any, batch_size: int) -> int:
+    """Process the decoded frames in windows on the executor, ``write_frames`` gets them back in order.
+
+    Returns the number of frames written.
+    """
+    pending: Deque[Future] = collections.deque()
+    frame_total = 0
+    try:
+        while True:
+            frames = []
+            while len(frames) < batch_size:
+                frame = read_frame(decoder.process.stdout, width, height)
+                if frame is None:
+                    break
+                frames.append(frame)
+            if frames:
+                pending.append(executor.submit(process_window, frame_processors, source_face, frames))
+            # write finished windows in order, wait for the oldest once the window budget is used up
+            while pending and (not frames or len(pending) >= max_in_flight or pending[0].done()):
+                processed_frames = pending.popleft().result()
+                write_frames(processed_frames)
+                progress.update(len(processed_frames))
+                frame_total += len(processed_frames)
+            if not frames:
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+    return frame_total
+
+
+def process_video_segment(video_job: VideoJob, segment: Dict[str, Any], executor: Executor, max_in_flight: int, frame_processors: List[Any], source_face: Any, width: int, height: int, fps: float, progress: Any, batch_size: int, accurate_seek: bool = False) -> bool:
+    """Decode one keyframe aligned segment, process it and encode it into its own segment file."""
+    # the seek lands on the keyframe at or before half a frame past the segment start, the probed timestamps
+    # are absolute and without an accurate seek the decoder starts right at the keyframe, an accurate seek
+    # drops the frames before half a frame ahead of the segment start instead
+    if accurate_seek:
+        seek_args = ['-seek_timestamp', '1', '-ss', f"{segment['start_time'] - 0.5 / fps:.6f}"]
+    else:
+        seek_args = ['-noaccurate_seek', '-seek_timestamp', '1', '-ss', f"{segment['start_time'] + 0.5 / fps:.6f}"]
+    decoder = FFmpegPipe([
+        '-hwaccel', 'auto',
+        *seek_args,
+        '-i', video_job.target_path,
+        '-map', '0:v:0', '-vsync', 'passthrough', '-frames:v', str(segment['frame_count']),
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'
+    ], stdout=subprocess.PIPE)
+    segment_path = video_job.get_segment_path(segment)
+    encoder = FFmpegPipe(get_encode_args(width, height, fps) + get_video_codec_args() + ['-f', 'matroska', '-y', segment_path + '.part'], stdin=subprocess.PIPE)
+
+    def write_frames(frames: List[Frame]) -> None:
+        for frame in frames:
+            write_frame(encoder.process.stdin, frame)
+
+    try:
+        frame_total = run_video_pipeline(decoder, executor, max_in_flight, frame_processors, source_face, width, height, write_frames, progress, batch_size)
+        encoder.process.stdin.close()
+    except OSError as exception:
+        logger.error(f"Video pipeline encoder of segment {segment['index']} failed: {exception}")
+        decoder.process.kill()
+        encoder.process.kill()
+        decoder.wait()
+        encoder.wait()
+        return False
+    if not decoder.wait() or not encoder.wait():
+        return False
+    if frame_total != segment['frame_count']:
+        # a missing or doubled frame shifts every later segment against the audio, the segment is not done
+        os.remove(segment_path + '.part')
+        if progress:
+            progress.update(-frame_total)
+        if accurate_seek:
+            logger.error(f"Video pipeline segment {segment['index']} decoded {frame_total} of {segment['frame_count']} frames")
+            return False
+        # an open GOP keyframe can decode frames before the segment start, an accurate seek starts on the frame
+        logger.warning(f"Video pipeline segment {segment['index']} decoded {frame_total} of {segment['frame_count']} frames, retrying with an accurate seek")
+        return process_video_segment(video_job, segment, executor, max_in_flight, frame_processors, source_face, width, height, fps, progress, batch_size, accurate_seek=True)
+    os.replace(segment_path + '.part', segment_path)
+    video_job.set_segment_done(segment)
+    return True
+
+
+def process_video_stream(source_path: str, target_path: str, output_path: str, batch_size: int = 4) -> bool:
+    """Decode, process and encode the target video in memory, with the target's audio mapped into the output.
+
+    Frames go from ffmpeg decoder pipes through every frame processor to
+    ffmpeg encoder pipes, no frame is written to disk. Windows of
+    ``batch_size`` frames are processed by ``execution_threads`` threads and
+    written in order, at most two windows per thread are held in memory.
+
+    With a ``video_segment_duration`` the target is split into keyframe
+    aligned segments tracked by a VideoJob next to the temp frames. Up to
+    ``video_segment_workers`` segments are decoded and encoded at once while
+    they share the processing threads, so encoding overlaps inference. An
+    interrupted run resumes with the segments that are not done, and the
+    segments are joined without re-encoding. Without a segment duration the
+    frames go straight into a single encode.
+    """
+    width, height = detect_resolution(target_path)
+    fps = detect_fps(target_path) if modules.globals.keep_fps else 30.0
+    segment_duration = modules.globals.video_segment_duration
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    execution_threads = modules.globals.execution_threads or 1
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+
+    if segment_duration <= 0:
+        source_face = get_chain_source_face(frame_processors, source_path)
+        decoder = FFmpegPipe(['-hwaccel', 'auto', '-i', target_path, '-map', '0:v:0', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'], stdout=subprocess.PIPE)
+        encoder = FFmpegPipe(get_encode_args(width, height, fps) + get_audio_args(target_path) + get_video_codec_args() + ['-y', output_path], stdin=subprocess.PIPE)
+
+        def write_frames(frames: List[Frame]) -> None:
+            for frame in frames:
+                write_frame(encoder.process.stdin, frame)
+
+        with ThreadPoolExecutor(max_workers=execution_threads) as executor, tqdm(total=get_video_frame_total(target_path), desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+            progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': execution_threads, 'video_pipeline': 'stream'})
+            try:
+                run_video_pipeline(decoder, executor, execution_threads * 2, frame_processors, source_face, width, height, write_frames, progress, batch_size)
+                encoder.process.stdin.close()
+            except OSError as exception:
+                logger.error(f"Video pipeline encoder failed: {exception}")
+                decoder.process.kill()
+                encoder.process.kill()
+                decoder.wait()
+                encoder.wait()
+                return False
+        decoded = decoder.wait()
+        return encoder.wait() and decoded
+
+    video_job = VideoJob(os.path.join(get_temp_directory_path(target_path), VIDEO_JOB_DIRECTORY), get_video_job_key(frame_processors, source_path, target_path, width, height, fps, segment_duration), target_path)
+    if not video_job.segments:
+        video_job.plan(probe_keyframe_segments(target_path, segment_duration))
+    pending_segments = video_job.get_pending_segments()
+    if len(pending_segments) < len(video_job.segments):
+        logger.info(f"Resuming video job, {len(video_job.segments) - len(pending_segments)} of {len(video_job.segments)} segments done")
+
+    if pending_segments:
+        source_face = get_chain_source_face(frame_processors, source_path)
+        segment_workers = max(1, min(modules.globals.video_segment_workers, len(pending_segments)))
+        # the windows in flight are shared between the segments being processed
+        max_in_flight = max(2, execution_threads * 2 // segment_workers)
+        frame_total = sum(segment['frame_count'] for segment in video_job.segments)
+        with ThreadPoolExecutor(max_workers=execution_threads) as executor, ThreadPoolExecutor(max_workers=segment_workers) as segment_executor, tqdm(total=frame_total, initial=video_job.get_done_frames(), desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+            progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': execution_threads, 'segment_workers': segment_workers})
+            segment_futures = [
+                segment_executor.submit(process_video_segment, video_job, segment, executor, max_in_flight, frame_processors, source_face, width, height, fps, progress, batch_size)
+                for segment in pending_segments
+            ]
+            segments_done = True
+            for segment, segment_future in zip(pending_segments, segment_futures):
+                try:
+                    segments_done = segment_future.result() and segments_done
+                except Exception as exception:
+                    logger.error(f"Video pipeline segment {segment['index']} failed: {exception}")
+                    segments_done = False
+            if not segments_done:
+                return False
+
+    if not video_job.concat(output_path):
+        return False
+    video_job.remove()
+    return True